@@ -1,16 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+import time
+_startup_started = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g, has_app_context
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.orm import joinedload, make_transient_to_detached
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from database import db, migrate, User, Post, ChatMessage, message_broker, redis_client, ChatRoom
+from database import db, migrate, User, Post, ChatMessage, message_broker, redis_client, ChatRoom, ChatRoomKey, \
+    insert_messages_ignore_duplicates, insert_posts_ignore_duplicates, FORUM_CHANNEL, room_membership, \
+    chatroom_members, configure_database, prepare_database, claim_spare_room_keys, store_spare_room_keys, \
+    FORUM_STREAM, remote_identities, add_outbox_entries, claim_outbox_batch, release_outbox_entries, \
+    delete_outbox_entries
 from datetime import datetime
-from crypto_utils import ChatRoomCrypto
+from crypto_utils import ChatRoomCrypto, generate_rsa_keypair
+from key_pool import RoomKeyPool
+from subscriber import RedisSubscriber, StreamSubscriber
+from write_behind import WriteBehindWriter
+from outbox import OutboxPublisher
+from coalescer import EmitCoalescer
+from presence import PresenceTracker
+from utils import install_query_counter, TTLCache, make_offloader, StartupTimer
+from log_config import setup_logging, get_logger
+import metrics
+import wire
+import atexit
 import os
+import signal
 import socket
+import sys
 import uuid
-import json
+import itertools
 import threading
 
+setup_logging()
+logger = get_logger('app')
+message_log = get_logger('message')  # 逐条消息事件，DEBUG 级别并按 LOG_SAMPLE_RATE 采样
+
+# 启动耗时统计
+startup_timer = StartupTimer(_startup_started)
+startup_timer.record('imports', time.perf_counter() - _startup_started)
+
 # 初始化加密工具
-crypto = ChatRoomCrypto()
+with startup_timer.phase('crypto'):
+    crypto = ChatRoomCrypto(key_cache_size=int(os.environ.get('KEY_CACHE_SIZE', 256)))
 
 # 生成唯一的主机ID和端口相关的用户名
 HOST_ID = str(uuid.uuid4())
@@ -18,97 +50,545 @@ PORT = int(os.environ.get('PORT', 5001))
 USERNAME = f'user_port_{PORT}'  # 基于端口号创建唯一用户名
 EMAIL = f'user_{PORT}@example.com'  # 基于端口号创建唯一邮箱
 
+# 本实例的消息序号，与 HOST_ID 组合成全局唯一的消息ID
+_message_sequence = itertools.count(1)
+
+def new_message_uid():
+    """生成全局唯一的消息ID: <HOST_ID>-<序号>"""
+    return f"{HOST_ID}-{next(_message_sequence):012d}"
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///site.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+configure_database(app)
+# 测试模式下每个请求允许的最大查询数，0 表示不检查
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 0))
 
 # 初始化扩展
 db.init_app(app)
-migrate.init_app(app, db)
-socketio = SocketIO(app, cors_allowed_origins="*", logger=True, engineio_logger=True)
+migrate.init_app(app, db, render_as_batch=True)
+# 异步模式：threading（默认，开发用）、eventlet 或 gevent，协程模式需从 server.py 启动
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+# 集群模式：多个进程共用一个数据库，通过 Socket.IO 消息队列（如 redis://localhost:6379/0）互相转发 emit，
+# 聊天消息由收到它的进程保存一次，不再经 MessageBroker 在实例间复制
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+CLUSTER_MODE = SOCKETIO_MESSAGE_QUEUE is not None
+# 多进程共享同一端口时没有粘性会话，客户端只能使用 websocket 传输
+app.config['SOCKETIO_TRANSPORTS'] = [t for t in os.environ.get('SOCKETIO_TRANSPORTS', '').split(',') if t]
+# Socket.IO / Engine.IO 的逐包日志默认关闭，排查问题时用 SOCKETIO_LOGGER=1 / ENGINEIO_LOGGER=1 打开
+socketio = SocketIO(app, async_mode=ASYNC_MODE, message_queue=SOCKETIO_MESSAGE_QUEUE,
+                    cors_allowed_origins="*",
+                    logger=os.environ.get('SOCKETIO_LOGGER') == '1',
+                    engineio_logger=os.environ.get('ENGINEIO_LOGGER') == '1')
+# 阻塞的数据库和加解密工作在协程模式下放到线程池执行，避免卡住事件循环
+offload = make_offloader(ASYNC_MODE)
+# 预生成的聊天室密钥对，创建聊天室时不必在请求中生成 RSA 密钥；KEY_POOL_PROCESSES=0 时不使用进程池
+room_key_pool = RoomKeyPool(
+    generate_rsa_keypair,
+    size=int(os.environ.get('KEY_POOL_SIZE', 8)),
+    processes=int(os.environ.get('KEY_POOL_PROCESSES', 1)),
+    offload=offload
+)
+if app.config['QUERY_BUDGET']:
+    install_query_counter(app, app.config['QUERY_BUDGET'])
 
 @socketio.on('connect')
 def handle_connect():
-    print("客户端连接成功")
+    message_log.debug("客户端连接: %s", request.sid)
     
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("客户端断开连接")
+    message_log.debug("客户端断开连接: %s", request.sid)
+    for room_id in list(socket_rooms.get(request.sid, ())):
+        release_room_channel(request.sid, room_id)
 
-# Redis 订阅处理
-def handle_redis_messages():
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe('forum_channel')
-    
-    for message in pubsub.listen():
-        if message['type'] == 'message':
-            try:
-                data = json.loads(message['data'])
-                if data['type'] == 'chat':
-                    chat_data = data['data']
-                    if chat_data['host_id'] != HOST_ID:  # 只处理其他主机的消息
-                        with app.app_context():
-                            # 获取聊天室和解密消息
-                            room = ChatRoom.query.get(chat_data['room_id'])
-                            if not room:
-                                print(f"未找到聊天室: {chat_data['room_id']}")
-                                continue
-                                
-                            # 解密消息内容
-                            decrypted_content = crypto.decrypt_message(chat_data['content'], room.private_key)
-                            if not decrypted_content:
-                                print("消息解密失败")
-                                continue
-                            
-                            # 检查消息是否已存在
-                            existing_message = ChatMessage.query.filter_by(
-                                content=chat_data['content'],
-                                user_id=chat_data['user_id'],
-                                room_id=chat_data['room_id'],
-                                host_id=chat_data['host_id']
-                            ).first()
-                            
-                            if not existing_message:
-                                # 保存消息到数据库
-                                user = User.query.get(chat_data['user_id'])
-                                if user:
-                                    chat_message = ChatMessage(
-                                        content=chat_data['content'],  # 保存加密的消息
-                                        user_id=user.id,
-                                        room_id=chat_data['room_id'],
-                                        host_id=chat_data['host_id']
-                                    )
-                                    db.session.add(chat_message)
-                                    db.session.commit()
-                                    print(f"已保存来自其他实例的消息")
-                            
-                            # 广播解密后的消息到房间
-                            message_data = {
-                                'room_id': str(chat_data['room_id']),
-                                'user': chat_data['username'],
-                                'message': decrypted_content,  # 发送解密后的消息
-                                'timestamp': chat_data['timestamp']
-                            }
-                            print(f"Redis广播消息到房间 {chat_data['room_id']}: {message_data}")
-                            socketio.emit('message', message_data, room=str(chat_data['room_id']))
-                            
-            except Exception as e:
-                print(f"处理Redis消息时发生错误: {e}")
-                if 'db' in locals() and hasattr(db, 'session'):
-                    db.session.rollback()
+# 广播合并：EMIT_COALESCE_MS > 0 时同一聊天室在该窗口内的消息合并为一个 messages 事件（数组）发出，
+# 减少高频聊天室中每个连接收到的帧数；0 表示每条消息单独发出 message 事件
+EMIT_COALESCE_MS = int(os.environ.get('EMIT_COALESCE_MS', 0))
+
+def emit_room_messages(room_id, messages):
+    """把一个聊天室合并后的消息发出，只有一条时仍使用 message 事件"""
+    try:
+        with metrics.EMIT_SECONDS.time(source='coalesced'):
+            if len(messages) == 1:
+                socketio.emit('message', messages[0], room=room_id)
+            else:
+                socketio.emit('messages', {'room_id': room_id, 'messages': messages}, room=room_id)
+    except Exception as e:
+        logger.warning("合并广播到房间 %s 失败: %s", room_id, e)
+
+emit_coalescer = None
+if EMIT_COALESCE_MS > 0:
+    emit_coalescer = EmitCoalescer(emit_room_messages, EMIT_COALESCE_MS,
+                                   socketio.start_background_task, socketio.sleep)
+
+def emit_chat_message(message_data, source):
+    """广播一条聊天消息到房间，启用合并时先进入该聊天室的合并窗口"""
+    room_id = message_data['room_id']
+    if emit_coalescer is not None:
+        emit_coalescer.add(room_id, message_data)
+    else:
+        with metrics.EMIT_SECONDS.time(source=source):
+            socketio.emit('message', message_data, room=room_id)
+    metrics.CHAT_MESSAGES.inc(room=room_id, source=source)
+
+# 本实例各连接加入的聊天室 {sid: {room_id}}，决定需要订阅哪些聊天频道
+socket_rooms = {}
+socket_rooms_lock = threading.Lock()
+
+def retain_room_channel(sid, room_id):
+    """连接加入聊天室时订阅该聊天室的 Redis 频道（集群模式下只记录连接）"""
+    with socket_rooms_lock:
+        rooms = socket_rooms.setdefault(sid, set())
+        if room_id in rooms:
+            return
+        rooms.add(room_id)
+    if not CLUSTER_MODE:
+        redis_subscriber.retain(message_broker.chat_channel(room_id))
+
+def release_room_channel(sid, room_id):
+    """连接离开聊天室时释放频道，本实例没有成员时取消订阅"""
+    with socket_rooms_lock:
+        rooms = socket_rooms.get(sid)
+        if not rooms or room_id not in rooms:
+            return
+        rooms.discard(room_id)
+        if not rooms:
+            del socket_rooms[sid]
+    if not CLUSTER_MODE:
+        redis_subscriber.release(message_broker.chat_channel(room_id))
+    username, went_offline = presence.leave(sid, room_id)
+    if went_offline:
+        presence_events.add(room_id, ('left', username))
+
+def count_room_sockets():
+    """本实例各聊天室的连接数 {(room_id,): 连接数}，供 /metrics 采集"""
+    counts = {}
+    with socket_rooms_lock:
+        for rooms in socket_rooms.values():
+            for room_id in rooms:
+                counts[(room_id,)] = counts.get((room_id,), 0) + 1
+    return counts
+
+metrics.ROOM_ACTIVE_SOCKETS.set_function(count_room_sockets)
+metrics.CRYPTO_KEY_CACHE.set_function(
+    lambda: {(stat,): value for stat, value in crypto.cache_stats().items()})
+
+# 在线状态：各实例定期把在线用户写入 Redis（带过期时间），加入/离开事件在 PRESENCE_DEBOUNCE_MS
+# 毫秒内按聊天室合并为一个 presence 事件，代替每次加入都向整个聊天室广播一条系统消息
+presence = PresenceTracker(
+    redis_client, HOST_ID,
+    ttl=int(os.environ.get('PRESENCE_TTL', 30)),
+    heartbeat_interval=int(os.environ.get('PRESENCE_HEARTBEAT', 10))
+)
+PRESENCE_NAMES_SHOWN = 3
+
+def emit_presence(room_id, events):
+    """把合并窗口内的加入/离开事件汇总为一个 presence 事件发出"""
+    last_event = {}
+    for kind, username in events:
+        if username in last_event and last_event[username] != kind:
+            # 窗口内加入又离开（或离开又重新加入），相互抵消
+            del last_event[username]
+        else:
+            last_event[username] = kind
+    joined = sorted(u for u, kind in last_event.items() if kind == 'joined')
+    left = sorted(u for u, kind in last_event.items() if kind == 'left')
+    if not joined and not left:
+        return
+    try:
+        online = presence.online_counts([room_id])[room_id]
+        socketio.emit('presence', {
+            'room_id': room_id,
+            'joined': len(joined),
+            'left': len(left),
+            'joined_names': joined[:PRESENCE_NAMES_SHOWN],
+            'left_names': left[:PRESENCE_NAMES_SHOWN],
+            'online': online,
+            'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        }, room=room_id)
+    except Exception as e:
+        logger.warning("广播房间 %s 在线状态失败: %s", room_id, e)
+
+presence_events = EmitCoalescer(emit_presence, int(os.environ.get('PRESENCE_DEBOUNCE_MS', 2000)),
+                                socketio.start_background_task, socketio.sleep)
+
+# Redis 订阅处理：按批次解密、入库，每批只提交一次
+REMOTE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def remote_author_host(data):
+    """动态或聊天消息作者的 users.host_id；旧版本实例没有 author_host 时只能用发送实例的 HOST_ID"""
+    return data.get('author_host') or data['host_id']
+
+def remote_user_row(username, host_id, fields=None):
+    """其他实例用户在本地的行；只从动态或聊天消息得知的用户没有邮箱，使用占位邮箱"""
+    fields = fields or {}
+    return {
+        'username': username,
+        'email': fields.get('email') or f'{username}@{host_id}.invalid',
+        'avatar': fields.get('avatar') or 'default.jpg',
+        'created_at': datetime.strptime(fields['created_at'], REMOTE_TIME_FORMAT)
+        if fields.get('created_at') else datetime.utcnow(),
+        'host_id': host_id
+    }
+
+def ingest_remote_batch(users, posts, chats):
+    """保存一批来自其他实例的用户、动态和聊天消息，返回待广播的 (发布时间, 消息)
+
+    远程用户按 (username, 作者的 users.host_id) 映射为本地用户ID，动态和聊天消息按全局ID幂等写入，
+    整批只提交一次，写入失败时回滚并抛出异常。只做数据库和加解密工作，在协程模式下由 offload 放到线程池执行。
+    """
+    with app.app_context():
+        rooms = {}
+        rows = []
+        broadcasts = []
+        try:
+            # 本批次涉及的所有远程用户一次解析为本地ID，本地没有的批量插入
+            started = time.perf_counter()
+            identities = {}
+            for user_data in users:
+                identity = (user_data['username'], user_data['host_id'])
+                identities[identity] = remote_user_row(*identity, user_data)
+            for data in posts + chats:
+                identity = (data['username'], remote_author_host(data))
+                identities.setdefault(identity, remote_user_row(*identity))
+            local_ids = remote_identities.resolve(identities)
+            redis_subscriber.record('identities', time.perf_counter() - started)
+
+            post_rows = []
+            for post_data in posts:
+                user_id = local_ids.get((post_data['username'], remote_author_host(post_data)))
+                if user_id is None:
+                    logger.warning("无法映射动态作者: %s", post_data['username'])
+                    continue
+                post_rows.append({
+                    # 旧版本实例未发送 post_uid 时用来源主机和动态ID代替
+                    'post_uid': post_data.get('post_uid') or f"{post_data['host_id']}-post-{post_data['id']}",
+                    'title': post_data['title'],
+                    'content': post_data['content'],
+                    'date_posted': datetime.strptime(post_data['date_posted'], REMOTE_TIME_FORMAT),
+                    'user_id': user_id,
+                    'host_id': post_data['host_id']
+                })
+
+            started = time.perf_counter()
+            for chat_data in chats:
+                # 获取聊天室（同一批次内复用）
+                room_id = chat_data['room_id']
+                if room_id not in rooms:
+                    room = ChatRoom.query.get(room_id)
+                    rooms[room_id] = (room, get_room_wrapped_keys(room) if room else None)
+                room, wrapped_keys = rooms[room_id]
+                if not room:
+                    logger.warning("未找到聊天室: %s", room_id)
+                    continue
+
+                # 解密消息内容
+                decrypted_content = crypto.decrypt_message(
+                    chat_data['content'], room.private_key, wrapped_keys, room.id)
+                if not decrypted_content:
+                    logger.warning("消息解密失败: 房间 %s", room_id)
+                    continue
+
+                # 来源实例的用户ID在本地没有意义，使用映射后的本地用户ID
+                user_id = local_ids.get((chat_data['username'], remote_author_host(chat_data)))
+                # 旧版本实例未发送 message_uid 时用来源主机和消息ID代替
+                message_uid = chat_data.get('message_uid') or f"{chat_data['host_id']}-{chat_data['id']}"
+                if user_id is not None:
+                    rows.append({
+                        'message_uid': message_uid,
+                        'content': chat_data['content'],  # 保存加密的消息
+                        'timestamp': chat_data['timestamp'],
+                        'user_id': user_id,
+                        'room_id': room_id,
+                        'host_id': chat_data['host_id']
+                    })
+
+                broadcasts.append((chat_data.get('published_at'), {
+                    'room_id': str(room_id),
+                    'message_uid': message_uid,
+                    'user': chat_data['username'],
+                    'message': decrypted_content,  # 发送解密后的消息
+                    'timestamp': chat_data['timestamp'].strftime(REMOTE_TIME_FORMAT)
+                }))
+            redis_subscriber.record('decrypt', time.perf_counter() - started)
+
+            # 按全局ID幂等写入，已存在的动态和消息直接跳过
+            started = time.perf_counter()
+            insert_posts_ignore_duplicates(post_rows)
+            insert_messages_ignore_duplicates(rows)
+            db.session.commit()
+            elapsed = time.perf_counter() - started
+            redis_subscriber.record('commit', elapsed)
+            metrics.DB_COMMIT_SECONDS.observe(elapsed, source='relay')
+        except Exception:
+            db.session.rollback()
+            # 回滚后本批次新插入的用户不存在了，丢弃映射缓存
+            remote_identities.invalidate()
+            # 交给订阅流水线记录；Streams 模式下本批次不会被确认，留在待确认列表中
+            raise
+    return broadcasts
+
+def process_redis_batch(batch):
+    """处理一批来自其他实例的 Redis 消息，写入失败时抛出异常，订阅流水线不会确认该批次"""
+    # 只处理其他主机的消息，发布时间随消息传到广播环节，用于计算端到端延迟
+    remote = {'user': [], 'post': [], 'chat': []}
+    for data in batch:
+        if data.get('type') in remote and data['data'].get('host_id') != HOST_ID:
+            remote[data['type']].append(dict(data['data'], published_at=data.get('published_at')))
+    if not any(remote.values()):
+        return
+
+    broadcasts = offload(ingest_remote_batch, remote['user'], remote['post'], remote['chat'])
+    if remote['post']:
+        feed_cache.invalidate()
+
+    # 广播解密后的消息到房间，批次内保持原有顺序
+    started = time.perf_counter()
+    for published_at, message_data in broadcasts:
+        emit_chat_message(message_data, 'relay')
+        if published_at:
+            metrics.DELIVERY_SECONDS.observe(time.time() - published_at)
+    redis_subscriber.record('emit', time.perf_counter() - started)
+    logger.debug("已处理来自其他实例的 %d 条消息", len(batch))
+
+subscriber_options = dict(
+    workers=int(os.environ.get('REDIS_WORKERS', 4)),
+    queue_size=int(os.environ.get('REDIS_QUEUE_SIZE', 1000)),
+    batch_size=int(os.environ.get('REDIS_BATCH_SIZE', 100))
+)
+if message_broker.transport == 'streams':
+    # 消费者组名需在重启后保持不变，Redis 据此保存本实例的读取位置
+    redis_subscriber = StreamSubscriber(
+        redis_client,
+        FORUM_STREAM,
+        os.environ.get('STREAM_CONSUMER') or f'{socket.gethostname()}-{PORT}',
+        process_redis_batch,
+        reclaim_idle_ms=int(os.environ.get('STREAM_RECLAIM_IDLE_MS', 30000)),
+        **subscriber_options
+    )
+else:
+    # 能解码二进制格式的实例额外订阅能力频道，供发布端的 auto 模式协商
+    redis_subscriber = RedisSubscriber(
+        redis_client,
+        [FORUM_CHANNEL] + ([wire.WIRE_CAPABILITY_CHANNEL] if wire.binary_supported() else []),
+        process_redis_batch,
+        **subscriber_options
+    )
+metrics.SUBSCRIBER_QUEUE_DEPTH.set_function(
+    lambda: {(index,): q.qsize() for index, q in enumerate(redis_subscriber.queues)})
+
+def get_room_wrapped_keys(room):
+    """获取聊天室所有版本的封装密钥 {版本: 封装密钥}"""
+    return {key.version: key.wrapped_key for key in room.keys}
+
+def rotate_room_key(room):
+    """为聊天室生成新版本的对称密钥，旧版本保留用于解密历史消息"""
+    new_key = crypto.new_room_key(room.public_key, room.id)
+    if not new_key:
+        return None
+    latest = ChatRoomKey.query.filter_by(room_id=room.id)\
+        .order_by(ChatRoomKey.version.desc())\
+        .first()
+    key_row = ChatRoomKey(
+        room=room,
+        version=(latest.version + 1) if latest else 1,
+        wrapped_key=new_key['wrapped_key']
+    )
+    db.session.add(key_row)
+    return key_row
+
+def get_room_key(room):
+    """获取聊天室当前的对称密钥，旧聊天室首次发送消息时自动生成"""
+    key_row = ChatRoomKey.query.filter_by(room_id=room.id)\
+        .order_by(ChatRoomKey.version.desc())\
+        .first()
+    if not key_row:
+        key_row = rotate_room_key(room)
+        if not key_row:
+            return None
+        db.session.commit()
+    return {
+        'version': key_row.version,
+        'key': crypto.unwrap_room_key(key_row.wrapped_key, room.private_key, room.id)
+    }
+
+# 启动Redis订阅流水线
+with startup_timer.phase('redis'):
+    try:
+        if redis_client:
+            redis_client.ping()
+    except Exception as e:
+        logger.warning("Redis 连接失败: %s", e)
+    redis_subscriber.start()
+
+# 发件箱：发布到其他实例的消息与产生它的数据在同一事务中写入，由后台线程批量发布，
+# 请求路径上不访问 Redis；BROKER_OUTBOX=0 时恢复为提交后同步发布
+# 认领的租约：超过该时间仍未发布并删除的消息（发布者崩溃）可以被其他进程重新认领
+OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_MS', 30000)) / 1000.0
+
+def read_outbox_batch(limit):
+    with app.app_context():
+        try:
+            return [row._asdict() for row in claim_outbox_batch(limit, OUTBOX_LEASE_SECONDS)]
+        except Exception:
+            db.session.rollback()
+            raise
+
+def finish_outbox_batch(ids, published):
+    """发布成功时删除已认领的消息，失败时放弃认领"""
+    with app.app_context():
+        try:
+            if published:
+                delete_outbox_entries(ids)
+            else:
+                release_outbox_entries(ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+def publish_outbox_batch(limit):
+    """认领一批发件箱消息、发布并删除，返回条数；数据库操作放到线程池，Redis 管道在当前线程执行"""
+    entries = offload(read_outbox_batch, limit)
+    if not entries:
+        return 0
+    ids = [entry['id'] for entry in entries]
+    try:
+        message_broker.publish_entries(entries)
+    except Exception:
+        try:
+            offload(finish_outbox_batch, ids, False)
+        except Exception as e:
+            logger.warning("放弃认领发件箱消息失败，租约到期后重新发布: %s", e)
+        raise
+    offload(finish_outbox_batch, ids, True)
+    return len(entries)
+
+outbox_publisher = None
+if redis_client is not None and os.environ.get('BROKER_OUTBOX', '1') != '0':
+    outbox_publisher = OutboxPublisher(
+        publish_outbox_batch,
+        batch_size=int(os.environ.get('OUTBOX_BATCH', 200)),
+        poll_interval_ms=int(os.environ.get('OUTBOX_POLL_INTERVAL_MS', 1000)),
+        max_backoff_ms=int(os.environ.get('OUTBOX_MAX_BACKOFF_MS', 5000))
+    )
+
+# 聊天消息持久化方式：sync 每条消息单独提交；group 先广播，再由后台线程批量提交（group commit），
+# 进程异常退出时可能丢失最近 CHAT_FLUSH_INTERVAL_MS 毫秒内的消息
+CHAT_DURABILITY = os.environ.get('CHAT_DURABILITY', 'sync')
+
+def flush_chat_rows(items, source='group'):
+    """在一个事务中批量写入聊天消息及其发件箱消息，items 为 (消息行, 发件箱行或 None)
+
+    自己推入应用上下文并使用独立的会话，可以由 offload 放到没有应用上下文的原生线程中执行。
+    """
+    with app.app_context():
+        try:
+            with metrics.DB_COMMIT_SECONDS.time(source=source):
+                insert_messages_ignore_duplicates([row for row, _ in items])
+                add_outbox_entries([entry for _, entry in items if entry is not None])
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    if outbox_publisher is not None:
+        outbox_publisher.notify()
+
+chat_writer = None
+if CHAT_DURABILITY == 'group':
+    # 协程模式下写入线程是绿色线程，批量插入和提交放到线程池，不阻塞事件循环
+    chat_writer = WriteBehindWriter(
+        lambda items: offload(flush_chat_rows, items),
+        max_batch=int(os.environ.get('CHAT_FLUSH_BATCH', 100)),
+        max_delay_ms=int(os.environ.get('CHAT_FLUSH_INTERVAL_MS', 50)),
+        buffer_size=int(os.environ.get('CHAT_BUFFER_SIZE', 10000)),
+        max_backoff_ms=int(os.environ.get('CHAT_FLUSH_MAX_BACKOFF_MS', 5000)),
+        # 违反约束或数据无效的行重试也不会成功；数据库繁忙、连接断开等错误一直重试
+        is_permanent=lambda error: isinstance(error, (IntegrityError, DataError))
+    )
+    chat_writer.start()
+    atexit.register(chat_writer.stop)
+    metrics.CHAT_WRITER_ROWS.set_function(lambda: {
+        (state,): value for state, value in chat_writer.stats().items()
+        if state in ('buffered', 'retrying', 'flushed', 'dropped')
+    })
+
+@app.route('/stats/subscriber')
+def subscriber_stats():
+    """Redis 订阅流水线的队列深度和各阶段耗时"""
+    return jsonify(redis_subscriber.stats())
+
+@app.route('/stats/presence')
+def presence_stats():
+    """本实例跟踪的在线状态"""
+    return jsonify(presence.stats())
 
-# 启动Redis监听线程
-redis_thread = threading.Thread(target=handle_redis_messages)
-redis_thread.daemon = True
-redis_thread.start()
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标"""
+    return metrics.REGISTRY.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/stats/startup')
+def startup_stats():
+    """启动各阶段耗时（毫秒）"""
+    return jsonify(startup_timer.report())
+
+@app.route('/stats/crypto')
+def crypto_stats():
+    """解析后的密钥缓存的大小和命中情况"""
+    return jsonify(crypto.cache_stats())
+
+@app.route('/stats/key_pool')
+def key_pool_stats():
+    """预生成密钥池的库存和命中情况"""
+    return jsonify(room_key_pool.stats())
+
+@app.route('/stats/outbox')
+def outbox_stats():
+    """发件箱后台发布的统计"""
+    if outbox_publisher is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(outbox_publisher.stats(), enabled=True))
+
+@app.route('/stats/writer')
+def writer_stats():
+    """聊天消息后台写入的缓冲区状态"""
+    if chat_writer is None:
+        return jsonify({'durability': CHAT_DURABILITY})
+    return jsonify(dict(chat_writer.stats(), durability=CHAT_DURABILITY))
+
+# 当前端口用户的进程级缓存 {'id', 'username'}，用户表被重建时需调用 invalidate_current_user
+_current_user_cache = None
+
+def invalidate_current_user():
+    """清除当前用户的进程级缓存和本次请求的缓存"""
+    global _current_user_cache
+    _current_user_cache = None
+    if has_app_context():
+        g.pop('current_user', None)
 
 def get_current_user():
-    """获取当前端口对应的用户"""
+    """获取当前端口对应的用户
+
+    同一请求内缓存在 flask.g 上；跨请求只缓存 id、用户名和 host_id，
+    通过 merge(load=False) 挂到当前会话，不查询用户表，其余字段访问时再延迟加载。
+    """
+    global _current_user_cache
     try:
         # 确保在应用上下文中执行
-        if not app.app_context():
+        if not has_app_context():
             return None
+
+        user = g.get('current_user')
+        if user is not None:
+            return user
+
+        cached = _current_user_cache
+        if cached is not None:
+            user = User(id=cached['id'], username=cached['username'], host_id=cached['host_id'])
+            make_transient_to_detached(user)
+            g.current_user = db.session.merge(user, load=False)
+            return g.current_user
             
         # 查找或创建用户
         user = User.query.filter_by(username=USERNAME).first()
@@ -123,29 +603,35 @@ def get_current_user():
             try:
                 db.session.add(user)
                 db.session.commit()
-                print(f"新用户创建成功: {USERNAME}")
+                logger.info("新用户创建成功: %s", USERNAME)
+            except IntegrityError:
+                # 其他进程已经创建了同名用户
+                db.session.rollback()
+                user = User.query.filter_by(username=USERNAME).first()
+                if not user:
+                    return None
             except Exception as e:
                 db.session.rollback()
-                print(f"创建用户失败: {e}")
+                logger.error("创建用户失败: %s", e)
                 return None
+        _current_user_cache = {'id': user.id, 'username': user.username, 'host_id': user.host_id}
+        g.current_user = user
         return user
     except Exception as e:
-        print(f"获取用户失败: {e}")
+        logger.error("获取用户失败: %s", e)
         if 'db' in locals() and hasattr(db, 'session'):
             db.session.rollback()
         return None
 
 def init_database():
-    """初始化数据库"""
+    """初始化数据库：按需执行迁移并确保当前用户存在，不删除已有数据"""
     try:
         with app.app_context():
-            # 删除所有表（如果存在）
-            db.drop_all()
-            print("已删除旧表")
-            
-            # 创建所有表
-            db.create_all()
-            print("已创建新表")
+            # 数据库已是最新版本时跳过迁移
+            if prepare_database():
+                logger.info("数据库迁移完成")
+            else:
+                logger.info("数据库已是最新版本")
             
             # 确保当前用户存在
             user = get_current_user()
@@ -153,30 +639,84 @@ def init_database():
                 try:
                     # 发布用户信息到其他实例
                     message_broker.publish_user(user)
-                    print(f"数据库初始化成功！当前用户: {USERNAME}")
+                    logger.info("数据库初始化成功！当前用户: %s", USERNAME)
                 except Exception as e:
-                    print(f"发布用户信息失败: {e}")
+                    logger.warning("发布用户信息失败: %s", e)
             else:
-                print("警告: 未能创建用户")
+                logger.warning("未能创建用户")
     except Exception as e:
-        print(f"数据库初始化失败: {e}")
+        logger.error("数据库初始化失败: %s", e)
         if 'db' in locals() and hasattr(db, 'session'):
             db.session.rollback()
         raise e
 
+FEED_PAGE_SIZE = 20
+
+# 帖子列表第一页的短时缓存，发帖或收到其他实例的帖子时清空
+feed_cache = TTLCache(ttl=float(os.environ.get('FEED_CACHE_TTL', 5)))
+# 帖子总数需要全表 COUNT，单独缓存更长时间，发帖时不清空（只用于显示，允许短时间不准确）
+feed_total_cache = TTLCache(ttl=float(os.environ.get('FEED_TOTAL_TTL', 60)))
+
+def count_feed_posts(user_id=None):
+    """帖子总数，优先使用缓存"""
+    cache_key = ('total', user_id)
+    total = feed_total_cache.get(cache_key)
+    if total is None:
+        count_query = Post.query if user_id is None else Post.query.filter_by(user_id=user_id)
+        total = count_query.count()
+        feed_total_cache.set(cache_key, total)
+    return total
+
+def query_feed(user_id=None, before=None, limit=FEED_PAGE_SIZE):
+    """按 (date_posted, id) 倒序键集分页查询帖子，只选取模板需要的列
+
+    返回 {'posts', 'has_more', 'next_before', 'total'}，第一页结果会被缓存，
+    total 由 count_feed_posts 单独缓存，翻页请求不会每次全表 COUNT。
+    """
+    cache_key = ('feed', user_id)
+    if before is None:
+        cached = feed_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    query = db.session.query(
+        Post.id, Post.title, Post.content, Post.date_posted, User.username
+    ).join(User, Post.user_id == User.id)
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+    if before:
+        cursor = db.session.query(Post.date_posted, Post.id).filter(Post.id == before).first()
+        if cursor:
+            query = query.filter(db.or_(
+                Post.date_posted < cursor.date_posted,
+                db.and_(Post.date_posted == cursor.date_posted, Post.id < cursor.id)
+            ))
+    rows = query.order_by(Post.date_posted.desc(), Post.id.desc()).limit(limit + 1).all()
+
+    posts = [dict(row._mapping) for row in rows[:limit]]
+    feed = {
+        'posts': posts,
+        'has_more': len(rows) > limit,
+        'next_before': posts[-1]['id'] if posts else None,
+        'total': count_feed_posts(user_id)
+    }
+    if before is None:
+        feed_cache.set(cache_key, feed)
+    return feed
+
 # 修改路由处理函数，添加错误处理
 @app.route('/')
 def home():
     try:
-        posts = Post.query.order_by(Post.date_posted.desc()).all()
+        feed = query_feed(before=request.args.get('before', type=int))
         current_user = get_current_user()
         if not current_user:
             flash('获取用户信息失败', 'error')
-            return render_template('home.html', posts=posts, current_user=None)
-        return render_template('home.html', posts=posts, current_user=current_user)
+            return render_template('home.html', feed=feed, current_user=None)
+        return render_template('home.html', feed=feed, current_user=current_user)
     except Exception as e:
         flash(f'发生错误: {str(e)}', 'error')
-        return render_template('home.html', posts=[], current_user=None)
+        return render_template('home.html', feed=None, current_user=None)
 
 @app.route('/post', methods=['POST'])
 def post():
@@ -213,10 +753,17 @@ def post():
             host_id=HOST_ID
         )
         db.session.add(post)
+        if outbox_publisher is not None:
+            db.session.flush()  # to_dict 需要动态ID
+            add_outbox_entries([message_broker.encode(*message_broker.post_message(post))])
         db.session.commit()
+        feed_cache.invalidate()
         
         # 发布到其他主机
-        message_broker.publish_post(post)
+        if outbox_publisher is not None:
+            outbox_publisher.notify()
+        else:
+            message_broker.publish_post(post)
         flash('发布成功！', 'success')
         return redirect(url_for('home'))
     except Exception as e:
@@ -234,13 +781,23 @@ def chat(room_id=None):
     
     # 获取用户的所有聊天室（已加入的）
     user_rooms = current_user.chatrooms.all()
+    user_room_ids = {room.id for room in user_rooms}
     
-    # 获取所有聊天室（包括未加入的）
-    all_rooms = ChatRoom.query.all()
+    # 获取所有聊天室（包括未加入的），创建者一并加载
+    all_rooms = ChatRoom.query.options(joinedload(ChatRoom.owner)).all()
+
+    # 各聊天室成员数，一次分组查询代替逐个加载 room.members
+    member_counts = dict(
+        db.session.query(chatroom_members.c.room_id, db.func.count())
+        .group_by(chatroom_members.c.room_id)
+        .all()
+    )
     
-    # 获取活动的聊天室和历史消息
+    # 已加入聊天室的在线人数，一次管道查询
+    online_counts = presence.online_counts(user_room_ids)
+
+    # 获取活动的聊天室（历史消息由 /chat/<room_id>/history 分页加载）
     active_room = None
-    chat_history = []
     available_users = []
     
     if room_id:
@@ -250,40 +807,16 @@ def chat(room_id=None):
             return redirect(url_for('chat'))
             
         # 检查用户是否是该聊天室的成员
-        is_member = current_user in active_room.members
+        is_member = room_membership.is_member(active_room.id, current_user.id)
         
         if not is_member:
             flash('你不是该聊天室的成员，无法查看内容', 'warning')
             return redirect(url_for('chat'))
         
-        # 获取聊天历史记录，按时间正序排列
-        encrypted_messages = ChatMessage.query.filter_by(room_id=room_id)\
-            .order_by(ChatMessage.timestamp.asc())\
-            .all()
-        
-        print(f"获取到 {len(encrypted_messages)} 条历史消息")
-        
-        # 解密并转换消息格式
-        chat_history = []
-        for msg in encrypted_messages:
-            try:
-                decrypted_content = crypto.decrypt_message(msg.content, active_room.private_key)
-                if decrypted_content:
-                    chat_history.append({
-                        'room_id': str(msg.room_id),
-                        'user': msg.author.username if msg.author else 'Unknown',
-                        'message': decrypted_content,
-                        'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-                    })
-            except Exception as e:
-                print(f"解密消息失败: {e}")
-        
-        print(f"处理后的历史消息: {len(chat_history)} 条")
-        
         # 获取可邀请的用户列表（仅聊天室创建者可见）
         if current_user.id == active_room.owner_id:
             available_users = User.query.filter(
-                ~User.id.in_([m.id for m in active_room.members])
+                ~User.id.in_(room_membership.member_ids_query(active_room.id))
             ).all()
     
     # 确保在模板中传递所有必要的变量
@@ -291,9 +824,72 @@ def chat(room_id=None):
                          current_user=current_user,
                          active_room=active_room,
                          user_rooms=user_rooms,
+                         user_room_ids=user_room_ids,
                          all_rooms=all_rooms,
-                         available_users=available_users,
-                         chat_history=chat_history)
+                         member_counts=member_counts,
+                         online_counts=online_counts,
+                         available_users=available_users)
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+@app.route('/chat/<int:room_id>/history')
+def chat_history(room_id):
+    """分页获取聊天历史：?before=<消息ID>&limit=<条数>，只解密返回的这一页"""
+    current_user = get_current_user()
+    if not current_user:
+        return jsonify({'error': '获取用户信息失败'}), 401
+
+    room = ChatRoom.query.get(room_id)
+    if not room:
+        return jsonify({'error': '聊天室不存在'}), 404
+    if not room_membership.is_member(room.id, current_user.id):
+        return jsonify({'error': '你不是该聊天室的成员'}), 403
+
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    # 按 (room_id, timestamp) 索引倒序做键集分页，id 用于同一时间戳内排序
+    query = ChatMessage.query.filter(ChatMessage.room_id == room_id)
+    if before:
+        cursor = ChatMessage.query.filter_by(id=before, room_id=room_id).first()
+        if not cursor:
+            return jsonify({'error': '无效的分页游标'}), 400
+        query = query.filter(db.or_(
+            ChatMessage.timestamp < cursor.timestamp,
+            db.and_(ChatMessage.timestamp == cursor.timestamp, ChatMessage.id < cursor.id)
+        ))
+    page = query.options(joinedload(ChatMessage.author))\
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())\
+        .limit(limit + 1)\
+        .all()
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()  # 页内按时间正序返回
+
+    # 解密并转换消息格式
+    messages = []
+    wrapped_keys = get_room_wrapped_keys(room)
+    for msg in page:
+        decrypted_content = crypto.decrypt_message(
+            msg.content, room.private_key, wrapped_keys, room.id)
+        if decrypted_content:
+            messages.append({
+                'id': msg.id,
+                'message_uid': msg.message_uid,
+                'room_id': str(msg.room_id),
+                'user': msg.author.username if msg.author else 'Unknown',
+                'message': decrypted_content,
+                'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+            })
+
+    return jsonify({
+        'messages': messages,
+        'has_more': has_more,
+        'next_before': page[0].id if page else None
+    })
 
 @app.route('/chat/create', methods=['POST'])
 def create_room():
@@ -311,7 +907,7 @@ def create_room():
     
     try:
         # 生成聊天室密钥对
-        keys = crypto.generate_room_keypair()
+        keys = room_key_pool.take()
         
         room = ChatRoom(
             name=name,
@@ -324,7 +920,10 @@ def create_room():
         room.members.append(current_user)  # 创建者自动加入聊天室
         
         db.session.add(room)
+        db.session.flush()
+        rotate_room_key(room)  # 生成第一版对称消息密钥
         db.session.commit()
+        room_membership.remember(room.id, [current_user.id])
         
         flash('聊天室创建成功！', 'success')
         return redirect(url_for('chat', room_id=room.id))
@@ -343,38 +942,54 @@ def invite_user(room_id):
         return redirect(url_for('chat', room_id=room_id))
     
     user_ids = request.form.getlist('user_id')
+    invited = []
     for user_id in user_ids:
         user = User.query.get(user_id)
-        if user and user not in room.members:
-            room.members.append(user)
+        if user and not room_membership.is_member(room.id, user.id):
+            room_membership.add_member(room.id, user.id)
+            invited.append(user.id)
     
     db.session.commit()
+    room_membership.remember(room.id, invited)
     flash('邀请发送成功！', 'success')
     return redirect(url_for('chat', room_id=room_id))
 
+@app.route('/chat/<int:room_id>/rotate_key', methods=['POST'])
+def rotate_key(room_id):
+    current_user = get_current_user()
+    room = ChatRoom.query.get_or_404(room_id)
+
+    if current_user.id != room.owner_id:
+        flash('只有聊天室创建者可以轮换密钥', 'error')
+        return redirect(url_for('chat', room_id=room_id))
+
+    try:
+        if not rotate_room_key(room):
+            raise ValueError('生成新密钥失败')
+        db.session.commit()
+        flash('聊天室密钥已轮换', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'轮换密钥失败: {str(e)}', 'error')
+    return redirect(url_for('chat', room_id=room_id))
+
 @socketio.on('join')
 def on_join(data):
     """处理加入房间事件"""
     try:
         room_id = str(data.get('room_id'))
-        print(f"正在处理加入房间请求: {room_id}")
         
         if room_id and room_id != 'null':
             join_room(room_id)
-            print(f"用户成功加入房间: {room_id}")
+            retain_room_channel(request.sid, room_id)
+            message_log.debug("连接 %s 加入房间 %s", request.sid, room_id)
             
-            # 发送加入通知
+            # 加入通知合并到 presence 事件中，同一用户的其他连接不再重复通知
             user = get_current_user()
-            if user:
-                system_message = {
-                    'room_id': room_id,
-                    'message': f'{user.username} 加入了聊天室',
-                    'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                }
-                emit('system_message', system_message, room=room_id)
-                print(f"已发送系统消息: {system_message}")
+            if user and presence.join(request.sid, room_id, user.username):
+                presence_events.add(room_id, ('joined', user.username))
     except Exception as e:
-        print(f"加入房间失败: {e}")
+        logger.warning("加入房间失败: %s", e)
 
 @socketio.on('leave')
 def on_leave(data):
@@ -383,98 +998,117 @@ def on_leave(data):
         room_id = str(data.get('room_id'))
         if room_id and room_id != 'null':
             leave_room(room_id)
-            print(f"用户离开房间: {room_id}")
+            release_room_channel(request.sid, room_id)
+            message_log.debug("连接 %s 离开房间 %s", request.sid, room_id)
     except Exception as e:
-        print(f"离开房间失败: {e}")
+        logger.warning("离开房间失败: %s", e)
 
 @socketio.on('message')
 def handle_message(data):
     """处理聊天消息"""
     try:
-        print(f"收到 WebSocket 消息: {data}")
         user = get_current_user()
         if not user:
-            print("未找到用户")
+            logger.warning("未找到当前用户")
             emit('error', {'message': '未找到用户'})
             return
         
         room_id = str(data.get('room_id'))
         content = data.get('content', '').strip()
         
-        print(f"处理消息 - 房间: {room_id}, 内容: {content}, 用户: {user.username}")
+        message_log.debug("收到消息 - 房间: %s, 长度: %d, 用户: %s", room_id, len(content), user.username)
         
         if not room_id:
-            print("无效的房间ID")
             emit('error', {'message': '无效的房间ID'})
             return
             
         if not content:
-            print("消息内容为空")
             emit('error', {'message': '消息内容不能为空'})
             return
         
         try:
             room = ChatRoom.query.get(int(room_id))
             if not room:
-                print(f"未找到房间: {room_id}")
+                logger.warning("未找到房间: %s", room_id)
                 emit('error', {'message': '未找到聊天室'})
                 return
                 
-            if user not in room.members:
-                print(f"用户 {user.username} 不是房间 {room_id} 的成员")
+            if not room_membership.is_member(room.id, user.id):
+                logger.warning("用户 %s 不是房间 %s 的成员", user.username, room_id)
                 emit('error', {'message': '你不是该聊天室的成员'})
                 return
             
             # 准备消息数据
+            now = datetime.utcnow()
             message_data = {
                 'room_id': room_id,
                 'user': user.username,
                 'message': content,
-                'timestamp': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                'timestamp': now.strftime('%Y-%m-%d %H:%M:%S')
             }
             
             try:
                 # 加密消息内容
-                print(f"开始加密消息，公钥长度: {len(room.public_key) if room.public_key else 0}")
-                encrypted_content = crypto.encrypt_message(content, room.public_key)
+                room_key = get_room_key(room)
+                encrypted_content = crypto.encrypt_message(content, room.public_key, room_key, room.id)
                 if not encrypted_content:
-                    print("消息加密失败，可能是公钥无效")
+                    logger.error("消息加密失败，可能是公钥无效: 房间 %s", room_id)
                     emit('error', {'message': '消息加密失败，请联系管理员'})
                     return
-                print("消息加密成功")
                 
-                # 创建并保存消息
+                # 创建并保存消息，ID 和时间戳在广播前就已确定
                 chat_message = ChatMessage(
+                    message_uid=new_message_uid(),
                     content=encrypted_content,
+                    timestamp=now,
                     user_id=user.id,
                     room_id=int(room_id),
                     host_id=HOST_ID
                 )
-                db.session.add(chat_message)
-                db.session.commit()
-                print("消息已保存到数据库")
+                # 客户端按 message_uid 合并实时消息和历史消息
+                message_data['message_uid'] = chat_message.message_uid
+                # 发布到其他实例的消息写入发件箱（集群模式下 emit 已经通过消息队列到达所有进程）
+                outbox_entry = None
+                if not CLUSTER_MODE and outbox_publisher is not None:
+                    outbox_entry = message_broker.encode(
+                        *message_broker.chat_message(chat_message, username=user.username,
+                                                     author_host=user.host_id))
+                chat_row = {
+                    'message_uid': chat_message.message_uid,
+                    'content': chat_message.content,
+                    'timestamp': chat_message.timestamp,
+                    'user_id': chat_message.user_id,
+                    'room_id': chat_message.room_id,
+                    'host_id': chat_message.host_id
+                }
+                if chat_writer is not None:
+                    # 后台批量写入，不在请求路径上等待 fsync
+                    chat_writer.submit((chat_row, outbox_entry))
+                else:
+                    # 线程池中没有应用上下文，由 flush_chat_rows 自己推入上下文并提交
+                    offload(flush_chat_rows, [(chat_row, outbox_entry)], source='message')
                 
                 # 发送到当前房间的所有用户
-                socketio.emit('message', message_data, room=room_id)
-                print(f"消息已广播到房间 {room_id}")
+                emit_chat_message(message_data, 'local')
+                message_log.debug("消息已广播到房间 %s", room_id)
                 
-                # 发布到其他实例
-                message_broker.publish_chat(chat_message)
-                print("消息已发布到其他实例")
+                # 未启用发件箱时同步发布到其他实例
+                if not CLUSTER_MODE and outbox_publisher is None:
+                    message_broker.publish_chat(chat_message, username=user.username, author_host=user.host_id)
                 
             except Exception as e:
-                print(f"保存消息时出错: {str(e)}")
+                logger.exception("保存消息时出错: %s", e)
                 db.session.rollback()
                 emit('error', {'message': '消息处理失败'})
                 return
                 
         except ValueError as e:
-            print(f"房间ID转换错误: {str(e)}")
+            logger.warning("房间ID转换错误: %s", e)
             emit('error', {'message': '无效的房间ID'})
             return
             
     except Exception as e:
-        print(f"处理消息时发生错误: {str(e)}")
+        logger.exception("处理消息时发生错误: %s", e)
         if 'db' in locals() and hasattr(db, 'session'):
             db.session.rollback()
         emit('error', {'message': '系统错误'})
@@ -487,46 +1121,81 @@ def profile():
             flash('获取用户信息失败', 'error')
             return redirect(url_for('home'))
         
-        user_posts = Post.query.filter_by(user_id=user.id).order_by(Post.date_posted.desc()).all()
-        return render_template('profile.html', user=user, user_posts=user_posts)
+        feed = query_feed(user_id=user.id, before=request.args.get('before', type=int))
+        return render_template('profile.html', user=user, feed=feed)
     except Exception as e:
         flash(f'发生错误: {str(e)}', 'error')
         return redirect(url_for('home'))
 
-if __name__ == '__main__':
+def save_spare_room_keys():
+    """进程退出时保存密钥池中未使用的密钥对"""
+    keys = room_key_pool.stop()
+    if not keys:
+        return
     try:
-        # 确保 instance 目录存在
-        if not os.path.exists('instance'):
-            os.makedirs('instance')
-            print("创建 instance 目录")
-        
-        # 删除旧的数据库文件
-        db_path = 'instance/site.db'
-        if os.path.exists(db_path):
-            os.remove(db_path)
-            print("已删除旧的数据库文件")
-        
-        # 初始化数据库
         with app.app_context():
-            init_database()
-            
-            # 验证数据库连接
-            try:
-                db.session.execute('SELECT 1')
-                print("数据库连接测试成功")
-            except Exception as e:
-                print(f"数据库连接测试失败: {e}")
-                raise e
+            store_spare_room_keys(keys)
+        logger.info("已保存 %d 个备用聊天室密钥", len(keys))
+    except Exception as e:
+        logger.warning("保存备用聊天室密钥失败: %s", e)
+
+def main(debug=True, init_db=True, **server_options):
+    """初始化数据库并启动服务器，server_options 会传给底层 WSGI 服务器
+
+    集群中的工作进程使用 init_db=False，数据库由 cluster.py 统一初始化。
+    """
+    try:
+        if init_db:
+            with startup_timer.phase('db'):
+                # 确保 instance 目录存在
+                os.makedirs(app.instance_path, exist_ok=True)
+                
+                # 初始化数据库（保留已有数据）
+                with app.app_context():
+                    init_database()
+                    
+                    # 验证数据库连接
+                    try:
+                        db.session.execute(text('SELECT 1'))
+                        logger.info("数据库连接测试成功")
+                    except Exception as e:
+                        logger.error("数据库连接测试失败: %s", e)
+                        raise e
+
+        # 取回上次退出时保存的备用密钥，再开始后台补充
+        with startup_timer.phase('key_pool'):
+            with app.app_context():
+                room_key_pool.add(claim_spare_room_keys(room_key_pool.size))
+            room_key_pool.start()
+            atexit.register(save_spare_room_keys)
+
+        # 发件箱表由迁移创建，数据库就绪后再开始发布（包括上次退出时未发布的消息）
+        if outbox_publisher is not None:
+            outbox_publisher.start()
+            outbox_publisher.notify()
+            atexit.register(outbox_publisher.stop)
+
+        # 在线状态心跳，退出时立即清除本实例的在线用户
+        if redis_client is not None:
+            socketio.start_background_task(presence.run_heartbeats, socketio.sleep)
+            atexit.register(presence.stop)
+
+        logger.info("启动耗时(ms): %s", startup_timer.report())
         
-        print(f"服务器将在 http://localhost:{PORT} 启动")
-        print(f"当前用户: {USERNAME}")
+        logger.info("服务器将在 http://localhost:%s 启动（async_mode=%s，进程 %s）", PORT, socketio.async_mode, os.getpid())
+        logger.info("当前用户: %s", USERNAME)
+
+        # 收到 SIGTERM 时正常退出，让 atexit 写完缓冲区中的聊天消息
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         
         # 启动服务器
         socketio.run(app, 
                     host='0.0.0.0',
                     port=PORT,
-                    debug=True)
+                    debug=debug,
+                    **server_options)
     except Exception as e:
-        print(f"启动服务器时发生错误: {e}")
-
+        logger.exception("启动服务器时发生错误: %s", e)
 
+if __name__ == '__main__':
+    main()
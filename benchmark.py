@@ -0,0 +1,550 @@
+"""性能基准：微基准、多实例压测，以及两次结果的对比
+
+    python benchmark.py micro --output bench_results/micro.json
+    python benchmark.py load --instances 2 --clients 50 --rooms 5 --output bench_results/load.json
+    python benchmark.py compare bench_results/old.json bench_results/new.json
+
+micro 在本进程内测量 ChatRoomCrypto 加解密和 MessageBroker 序列化（安装了 fakeredis 时发布到
+fakeredis，否则只做序列化）。load 使用临时 SQLite 数据库启动若干个 server.py 实例，用
+python-socketio 客户端模拟 N 个连接分布在 M 个聊天室中收发消息，并测量历史消息和首页动态的加载耗时。
+多个实例之间通过本机 Redis（localhost:6379）转发消息，没有 Redis 时只有同一实例内的连接能收到消息。
+结果为 JSON，包含当前提交号，便于在不同提交之间比较。
+"""
+import argparse
+import base64
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MESSAGE_PREFIX = 'bench'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(samples, scale=1000.0):
+    """耗时样本（秒）汇总为毫秒统计"""
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * scale, 3),
+        'p50_ms': round(percentile(samples, 0.50) * scale, 3),
+        'p99_ms': round(percentile(samples, 0.99) * scale, 3),
+        'max_ms': round(max(samples) * scale, 3),
+    }
+
+
+def measure(fn, iterations, warmup=3):
+    """重复调用 fn，返回每次调用的耗时统计和每秒次数"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    result = summarize(samples)
+    result['ops_per_sec'] = round(iterations / elapsed, 1) if elapsed else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results, output):
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if not output:
+        print(text)
+        return
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        f.write(text + '\n')
+    print(f"结果已保存到 {output}")
+
+
+# ---------------------------------------------------------------- 微基准
+
+def bench_crypto(iterations):
+    from crypto_utils import ChatRoomCrypto
+
+    crypto = ChatRoomCrypto()
+    keys = crypto.generate_room_keypair()
+    public_key, private_key = keys['public_key'], keys['private_key']
+    new_key = crypto.new_room_key(public_key, room_id=1)
+    wrapped = new_key['wrapped_key']
+    room_key = {'version': 1, 'key': new_key['key']}
+    message = '基准测试消息 benchmark message ' * 4
+    encrypted_v2 = crypto.encrypt_message(message, public_key, room_key, room_id=1)
+    encrypted_legacy = crypto.encrypt_message(message[:60], public_key, room_id=1)
+    # 解密失败只会返回 None，先确认测量的是成功路径
+    if crypto.decrypt_message(encrypted_v2, private_key, {1: wrapped}, room_id=1) != message:
+        raise RuntimeError('v2 消息解密失败，无法进行基准测试')
+    if crypto.decrypt_message(encrypted_legacy, private_key, room_id=1) != message[:60]:
+        raise RuntimeError('旧格式消息解密失败，无法进行基准测试')
+
+    def decrypt_cold():
+        crypto.invalidate_room(1)
+        crypto.decrypt_message(encrypted_v2, private_key, {1: wrapped}, room_id=1)
+
+    return {
+        'generate_room_keypair': measure(crypto.generate_room_keypair, max(1, iterations // 100), warmup=0),
+        'new_room_key': measure(lambda: crypto.new_room_key(public_key, room_id=1), iterations),
+        'encrypt_v2': measure(lambda: crypto.encrypt_message(message, public_key, room_key, room_id=1), iterations),
+        'decrypt_v2_cached': measure(
+            lambda: crypto.decrypt_message(encrypted_v2, private_key, {1: wrapped}, room_id=1), iterations),
+        'decrypt_v2_cold': measure(decrypt_cold, max(1, iterations // 10)),
+        'encrypt_legacy_rsa': measure(lambda: crypto.encrypt_message(message[:60], public_key, room_id=1), iterations),
+        'decrypt_legacy_rsa': measure(
+            lambda: crypto.decrypt_message(encrypted_legacy, private_key, room_id=1), max(1, iterations // 10)),
+    }
+
+
+class _NullPipeline:
+    """_NullRedis 的管道：收集命令，execute 时丢弃"""
+
+    def __init__(self):
+        self.commands = []
+
+    def publish(self, channel, payload):
+        self.commands.append(payload)
+
+    def xadd(self, stream, fields, **kwargs):
+        self.commands.append(fields)
+
+    def execute(self):
+        results = [0] * len(self.commands)
+        self.commands = []
+        return results
+
+
+class _NullRedis:
+    """没有 fakeredis 时的发布目标：只接收序列化后的消息"""
+
+    def publish(self, channel, payload):
+        return 0
+
+    def pipeline(self, transaction=True):
+        return _NullPipeline()
+
+    def pubsub(self):
+        return None
+
+
+def bench_broker(iterations):
+    from database import ChatMessage, MessageBroker
+    import wire
+
+    try:
+        import fakeredis
+        sink, sink_name = fakeredis.FakeRedis(), 'fakeredis'
+    except ImportError:
+        sink, sink_name = _NullRedis(), 'null'
+    chat_message = ChatMessage(
+        id=1,
+        message_uid='bench-000000000001',
+        content='v2:1:' + base64.b64encode(os.urandom(12 + 64 + 16)).decode('utf-8'),
+        timestamp=datetime.utcnow(),
+        user_id=1,
+        room_id=1,
+        host_id='bench-host'
+    )
+
+    results = {'sink': sink_name}
+    formats = ['json'] + (['binary'] if wire.binary_supported() else [])
+    for wire_format in formats:
+        broker = MessageBroker(sink, wire_format=wire_format)
+        payload = wire.encode({'type': 'chat', 'published_at': time.time(), 'data': {
+            'id': 1, 'message_uid': chat_message.message_uid, 'content': chat_message.content,
+            'user_id': 1, 'room_id': 1, 'host_id': 'bench-host', 'username': 'bench', 'author_host': 'bench-host',
+            'timestamp': chat_message.timestamp}}, binary=wire_format == 'binary')
+        results[wire_format] = {
+            'payload_bytes': len(payload),
+            'publish_chat': measure(lambda: broker.publish_chat(chat_message, username='bench'), iterations),
+            'decode_chat': measure(lambda: wire.decode(payload), iterations),
+        }
+    return results
+
+
+def run_micro(args):
+    return {
+        'crypto': bench_crypto(args.iterations),
+        'broker': bench_broker(args.iterations),
+    }
+
+
+# ---------------------------------------------------------------- 多实例压测
+
+class Instance:
+    """一个 server.py 子进程"""
+
+    def __init__(self, port, env):
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'server.py')],
+                                        env=dict(env, PORT=str(port)), cwd=BASE_DIR)
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"端口 {self.port} 的实例已退出，返回码 {self.process.returncode}")
+            try:
+                with urllib.request.urlopen(f'{self.url}/stats/startup', timeout=2) as response:
+                    return json.loads(response.read())
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f"端口 {self.port} 的实例在 {timeout} 秒内没有就绪")
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout=30) as response:
+            return response.read()
+
+    def post_form(self, path, fields):
+        data = urllib.parse.urlencode(fields, doseq=True).encode('utf-8')
+        with urllib.request.urlopen(self.url + path, data=data, timeout=30) as response:
+            return response.read()
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def timed_requests(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def create_room(instance, db_path, name):
+    """通过 HTTP 创建聊天室（走正常的生成密钥流程），并邀请所有实例的用户"""
+    instance.post_form('/chat/create', {'name': name, 'description': 'benchmark'})
+    with sqlite3.connect(db_path) as conn:
+        room_id = conn.execute('SELECT id FROM chatrooms WHERE name = ? ORDER BY id DESC', (name,)).fetchone()[0]
+        user_ids = [row[0] for row in conn.execute('SELECT id FROM users')]
+    instance.post_form(f'/chat/{room_id}/invite', {'user_id': user_ids})
+    return room_id
+
+
+def seed_messages(db_path, room_id, count):
+    """直接向数据库写入 count 条用聊天室当前密钥加密的消息"""
+    from crypto_utils import ChatRoomCrypto
+
+    crypto = ChatRoomCrypto()
+    with sqlite3.connect(db_path) as conn:
+        public_key, private_key, owner_id = conn.execute(
+            'SELECT public_key, private_key, owner_id FROM chatrooms WHERE id = ?', (room_id,)).fetchone()
+        version, wrapped_key = conn.execute(
+            'SELECT version, wrapped_key FROM chatroom_keys WHERE room_id = ? ORDER BY version DESC',
+            (room_id,)).fetchone()
+        room_key = {'version': version, 'key': crypto.unwrap_room_key(wrapped_key, private_key, room_id)}
+        started_at = datetime.utcnow() - timedelta(seconds=count)
+        rows = []
+        for index in range(count):
+            rows.append((
+                f'{MESSAGE_PREFIX}-{room_id}-{index:08d}',
+                crypto.encrypt_message(f'历史消息 {index}', public_key, room_key, room_id),
+                (started_at + timedelta(seconds=index)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                owner_id,
+                room_id,
+                'benchmark'
+            ))
+        conn.executemany(
+            'INSERT INTO chat_messages (message_uid, content, timestamp, user_id, room_id, host_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return [row[0] for row in conn.execute(
+            'SELECT id FROM chat_messages WHERE room_id = ? ORDER BY id', (room_id,))]
+
+
+def bench_history(instance, db_path, sizes, repeat):
+    results = {}
+    for size in sizes:
+        room_id = create_room(instance, db_path, f'{MESSAGE_PREFIX}-history-{size}')
+        message_ids = seed_messages(db_path, room_id, size)
+        middle = message_ids[len(message_ids) // 2]
+        results[str(size)] = {
+            'latest_page': timed_requests(lambda: instance.get(f'/chat/{room_id}/history'), repeat),
+            'middle_page': timed_requests(lambda: instance.get(f'/chat/{room_id}/history?before={middle}'), repeat),
+        }
+    return results
+
+
+def bench_feed(instance, db_path, sizes, repeat):
+    results = {}
+    with sqlite3.connect(db_path) as conn:
+        user_id = conn.execute('SELECT id FROM users ORDER BY id').fetchone()[0]
+    total = 0
+    for size in sorted(sizes):
+        # 逐档补足动态数量
+        with sqlite3.connect(db_path) as conn:
+            now = datetime.utcnow()
+            conn.executemany(
+                'INSERT INTO posts (post_uid, title, content, date_posted, user_id, host_id) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(f'benchmark-post-{index}', f'动态 {index}', '基准测试内容 ' * 10,
+                  (now - timedelta(seconds=size - index)).strftime('%Y-%m-%d %H:%M:%S.%f'),
+                  user_id, 'benchmark')
+                 for index in range(total, size)])
+            middle = conn.execute('SELECT id FROM posts ORDER BY id LIMIT 1 OFFSET ?', (size // 2,)).fetchone()[0]
+        total = size
+        results[str(size)] = {
+            'first_page': timed_requests(lambda: instance.get('/'), repeat),
+            'middle_page': timed_requests(lambda: instance.get(f'/?before={middle}'), repeat),
+        }
+    return results
+
+
+class LoadClient:
+    """一个模拟的 Socket.IO 连接：加入一个聊天室，发送并接收带发送时间的消息"""
+
+    def __init__(self, index, url, room_id, stats):
+        import socketio
+
+        self.index = index
+        self.url = url
+        self.room_id = room_id
+        self.stats = stats
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('message', self.on_message)
+        self.sio.on('messages', self.on_messages)  # EMIT_COALESCE_MS > 0 时的合并广播
+
+    def on_message(self, data, received_at=None):
+        received_at = received_at or time.time()
+        parts = str(data.get('message', '')).split(':')
+        if len(parts) != 4 or parts[0] != MESSAGE_PREFIX:
+            return
+        self.stats.record_delivery(received_at - float(parts[1]), received_at)
+
+    def on_messages(self, data):
+        received_at = time.time()
+        for message in data.get('messages', []):
+            self.on_message(message, received_at)
+
+    def connect(self):
+        self.sio.connect(self.url, transports=['websocket'])
+        self.sio.emit('join', {'room_id': str(self.room_id)})
+
+    def send(self, count, interval):
+        for seq in range(count):
+            self.sio.emit('message', {
+                'room_id': str(self.room_id),
+                'content': f'{MESSAGE_PREFIX}:{time.time():.6f}:{self.index}:{seq}'
+            })
+            self.stats.record_send()
+            if interval:
+                time.sleep(interval)
+
+    def disconnect(self):
+        self.sio.disconnect()
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.sent = 0
+        self.first_send = None
+        self.last_delivery = None
+
+    def record_send(self):
+        with self.lock:
+            self.sent += 1
+            if self.first_send is None:
+                self.first_send = time.time()
+
+    def record_delivery(self, latency, received_at):
+        with self.lock:
+            self.latencies.append(latency)
+            self.last_delivery = received_at
+
+
+def bench_load(instances, room_ids, args):
+    stats = LoadStats()
+    clients = [LoadClient(index, instances[index % len(instances)].url, room_ids[index % len(room_ids)], stats)
+               for index in range(args.clients)]
+    for client in clients:
+        client.connect()
+    time.sleep(1.0)  # 等待加入聊天室和频道订阅生效
+
+    threads = [threading.Thread(target=client.send, args=(args.messages, args.send_interval)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 每条消息应送达同一聊天室内的所有连接（包括发送者）
+    room_sizes = {}
+    for client in clients:
+        room_sizes[client.room_id] = room_sizes.get(client.room_id, 0) + 1
+    expected = sum(room_sizes[client.room_id] * args.messages for client in clients)
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline and len(stats.latencies) < expected:
+        time.sleep(0.1)
+
+    for client in clients:
+        client.disconnect()
+
+    delivered = len(stats.latencies)
+    duration = (stats.last_delivery - stats.first_send) if delivered else None
+    result = summarize(stats.latencies)
+    result.update({
+        'clients': args.clients,
+        'rooms': len(room_ids),
+        'sent': stats.sent,
+        'expected_deliveries': expected,
+        'delivered': delivered,
+        'delivery_ratio': round(delivered / expected, 4) if expected else None,
+        'sent_per_sec': round(stats.sent / duration, 1) if duration else None,
+        'delivered_per_sec': round(delivered / duration, 1) if duration else None,
+    })
+    return result
+
+
+def run_load(args):
+    workdir = tempfile.mkdtemp(prefix='web3_social_bench_')
+    db_path = os.path.join(workdir, 'bench.db')
+    env = dict(os.environ,
+               DATABASE_URL=f'sqlite:///{db_path}',
+               ASYNC_MODE=args.async_mode,
+               FEED_CACHE_TTL='0',  # 测量真实查询耗时
+               LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+               INIT_DATABASE='0',
+               PORT=str(args.port))
+    if args.message_queue:
+        env.update(SOCKETIO_MESSAGE_QUEUE=args.message_queue, SOCKETIO_TRANSPORTS='websocket')
+
+    instances = []
+    try:
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, 'init_db.py')], env=env, cwd=BASE_DIR, check=True)
+        instances = [Instance(args.port + index, env) for index in range(args.instances)]
+        startup = [instance.wait_ready() for instance in instances]
+        for instance in instances:
+            instance.get('/')  # 确保各实例的用户已创建
+
+        owner = instances[0]
+        room_ids = [create_room(owner, db_path, f'{MESSAGE_PREFIX}-load-{index}') for index in range(args.rooms)]
+        return {
+            'instances': args.instances,
+            'async_mode': args.async_mode,
+            'cluster': bool(args.message_queue),
+            'startup_ms': startup,
+            'chat': bench_load(instances, room_ids, args),
+            'history': bench_history(owner, db_path, args.history_sizes, args.repeat),
+            'feed': bench_feed(owner, db_path, args.feed_sizes, args.repeat),
+        }
+    finally:
+        for instance in instances:
+            instance.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------- 结果对比
+
+def flatten(data, prefix=''):
+    items = {}
+    for key, value in data.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            items.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[path] = value
+    return items
+
+
+def run_compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = flatten(json.load(f).get('results', {}))
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = flatten(json.load(f).get('results', {}))
+    print(f"{'指标':<60} {'基线':>12} {'当前':>12} {'变化':>9}")
+    for key in sorted(set(baseline) & set(candidate)):
+        old, new = baseline[key], candidate[key]
+        change = f'{(new - old) / old * 100:+.1f}%' if old else '-'
+        print(f'{key:<60} {old:>12} {new:>12} {change:>9}')
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Web3 Social 性能基准')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    micro = subparsers.add_parser('micro', help='加解密和消息序列化微基准')
+    micro.add_argument('--iterations', type=int, default=1000, help='每项测量的调用次数')
+    micro.add_argument('--output', help='结果 JSON 文件，默认输出到标准输出')
+
+    load = subparsers.add_parser('load', help='启动实例并模拟客户端压测')
+    load.add_argument('--instances', type=int, default=1, help='实例数')
+    load.add_argument('--port', type=int, default=5101, help='第一个实例的端口，其余实例依次加一')
+    load.add_argument('--async-mode', default='eventlet', choices=['eventlet', 'gevent'])
+    load.add_argument('--message-queue', help='使用集群模式时的 Socket.IO 消息队列地址')
+    load.add_argument('--clients', type=int, default=20, help='模拟的连接数 N')
+    load.add_argument('--rooms', type=int, default=4, help='聊天室数 M')
+    load.add_argument('--messages', type=int, default=20, help='每个连接发送的消息数')
+    load.add_argument('--send-interval', type=float, default=0.01, help='同一连接两次发送的间隔（秒）')
+    load.add_argument('--drain-timeout', type=float, default=10.0, help='发送结束后等待送达的最长时间（秒）')
+    load.add_argument('--history-sizes', type=parse_sizes, default=[100, 1000, 10000], help='历史消息测量的聊天室大小')
+    load.add_argument('--feed-sizes', type=parse_sizes, default=[100, 1000, 10000], help='首页动态测量的动态数量')
+    load.add_argument('--repeat', type=int, default=20, help='每个页面请求的次数')
+    load.add_argument('--output', help='结果 JSON 文件，默认输出到标准输出')
+
+    compare = subparsers.add_parser('compare', help='比较两次结果')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'compare':
+        run_compare(args)
+        return
+
+    runner = run_micro if args.command == 'micro' else run_load
+    options = {key: value for key, value in vars(args).items() if key != 'output'}
+    write_results({
+        'benchmark': args.command,
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'options': options,
+        'results': runner(args),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""本机多进程集群：N 个 eventlet 工作进程共享同一端口，通过 Redis 消息队列互相转发 Socket.IO 事件
+
+    python cluster.py --workers 4 --port 5000
+    python cluster.py --workers 8 --port 5000 --message-queue redis://localhost:6379/0
+
+工作进程通过 SO_REUSEPORT 监听同一端口，由内核分配连接；没有粘性会话，
+因此客户端只使用 websocket 传输。所有进程共用 DATABASE_URL 指向的数据库，
+每条聊天消息只由收到它的进程加密保存一次。
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='启动本机多进程 Socket.IO 集群')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2, help='工作进程数')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5001)), help='共享监听端口')
+    parser.add_argument('--message-queue', default=os.environ.get('SOCKETIO_MESSAGE_QUEUE', 'redis://localhost:6379/0'),
+                        help='Socket.IO 消息队列地址')
+    parser.add_argument('--skip-init-db', action='store_true', help='不重新初始化数据库')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    env = dict(os.environ,
+               PORT=str(args.port),
+               ASYNC_MODE='eventlet',
+               SOCKETIO_MESSAGE_QUEUE=args.message_queue,
+               SOCKETIO_TRANSPORTS='websocket',
+               INIT_DATABASE='0')
+
+    # 数据库只初始化一次，避免工作进程互相删除数据
+    if not args.skip_init_db:
+        subprocess.run([sys.executable, os.path.join(BASE_DIR, 'init_db.py')], env=env, check=True)
+
+    workers = []
+    for index in range(args.workers):
+        workers.append(subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'server.py')], env=env))
+        print(f"已启动工作进程 {index + 1}/{args.workers}，PID {workers[-1].pid}")
+    print(f"集群已在 http://localhost:{args.port} 启动，消息队列: {args.message_queue}")
+
+    def stop(signum=None, frame=None):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        # 任一工作进程退出时关闭整个集群
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(0.5)
+        print("有工作进程退出，正在关闭集群")
+    except KeyboardInterrupt:
+        pass
+    stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import threading
+
+
+class EmitCoalescer:
+    """按聊天室合并短时间内的广播
+
+    聊天室收到第一条待广播消息时启动一个后台任务，window_ms 毫秒后把这段时间内
+    该聊天室的所有消息交给 emit_batch(room_id, messages) 一次发出。
+    每条消息增加的延迟不超过 window_ms。start_task / sleep 使用 Socket.IO 提供的
+    实现（socketio.start_background_task / socketio.sleep），在各种异步模式下都可用。
+    """
+
+    def __init__(self, emit_batch, window_ms, start_task, sleep):
+        self.emit_batch = emit_batch
+        self.window = window_ms / 1000.0
+        self.start_task = start_task
+        self.sleep = sleep
+        self._pending = {}  # {room_id: [消息]}
+        self._lock = threading.Lock()
+
+    def add(self, room_id, message):
+        with self._lock:
+            messages = self._pending.get(room_id)
+            if messages is not None:
+                messages.append(message)
+                return
+            self._pending[room_id] = [message]
+        self.start_task(self._flush_later, room_id)
+
+    def _flush_later(self, room_id):
+        self.sleep(self.window)
+        with self._lock:
+            messages = self._pending.pop(room_id, None)
+        if messages:
+            self.emit_batch(room_id, messages)
@@ -1,59 +1,200 @@
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
 from cryptography.exceptions import InvalidKey
+from collections import OrderedDict
 import base64
+import hashlib
+import os
+import threading
+
+from log_config import get_logger
+from metrics import CRYPTO_SECONDS
+
+logger = get_logger('crypto')
+
+# 消息格式版本标记：v2 为 "v2:<密钥版本>:<Base64(nonce + 密文)>"
+# 没有版本前缀的旧消息是直接用 RSA-OAEP 加密的 Base64 数据
+MESSAGE_FORMAT_V2 = 'v2'
+NONCE_SIZE = 12
+
+def generate_rsa_keypair():
+    """生成新的RSA密钥对 {'private_key', 'public_key'}（PEM），失败时返回 None
+
+    模块级函数，可以在进程池中执行。
+    """
+    try:
+        # 生成私钥
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048
+        )
+        
+        # 获取公钥
+        public_key = private_key.public_key()
+        
+        # 序列化私钥
+        private_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        
+        # 序列化公钥
+        public_pem = public_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        
+        return {
+            'private_key': private_pem.decode('utf-8'),
+            'public_key': public_pem.decode('utf-8')
+        }
+    except Exception as e:
+        logger.error("生成密钥对时出错: %s", e)
+        return None
 
 class ChatRoomCrypto:
-    def __init__(self):
+    def __init__(self, key_cache_size=256):
         self.padding = padding.OAEP(
             mgf=padding.MGF1(algorithm=hashes.SHA256()),
             algorithm=hashes.SHA256(),
             label=None
         )
+        # 已解析的密钥对象 LRU 缓存，键为 (类型, 聊天室ID, 密钥指纹)
+        # 类型: 'private' / 'public' 为 RSA 密钥对象，'room' 为解封后的对称密钥
+        self.key_cache_size = key_cache_size
+        self._key_cache = OrderedDict()
+        self._key_cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    @staticmethod
+    def key_fingerprint(key_data):
+        """计算 PEM 或封装密钥字符串的指纹"""
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()[:16]
+
+    def _cached_key(self, kind, room_id, key_data, loader):
+        """从缓存获取密钥对象，未命中时调用 loader 解析并写入缓存"""
+        cache_key = (kind, room_id, self.key_fingerprint(key_data))
+        with self._key_cache_lock:
+            key = self._key_cache.get(cache_key)
+            if key is not None:
+                self._key_cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                return key
+            self.cache_misses += 1
+
+        key = loader(key_data)
+
+        with self._key_cache_lock:
+            if kind != 'room' and room_id is not None:
+                # 聊天室的RSA密钥已变更，丢弃该聊天室旧指纹的缓存
+                for stale in [k for k in self._key_cache
+                              if k[0] == kind and k[1] == room_id and k != cache_key]:
+                    del self._key_cache[stale]
+            self._key_cache[cache_key] = key
+            self._key_cache.move_to_end(cache_key)
+            while len(self._key_cache) > self.key_cache_size:
+                self._key_cache.popitem(last=False)
+        return key
+
+    def _load_private_key(self, private_key_pem, room_id=None):
+        return self._cached_key(
+            'private', room_id, private_key_pem,
+            lambda pem: load_pem_private_key(pem.encode('utf-8'), password=None)
+        )
+
+    def _load_public_key(self, public_key_pem, room_id=None):
+        return self._cached_key(
+            'public', room_id, public_key_pem,
+            lambda pem: load_pem_public_key(pem.encode('utf-8'))
+        )
+
+    def invalidate_room(self, room_id):
+        """聊天室密钥变更时删除该聊天室的所有缓存项"""
+        with self._key_cache_lock:
+            for stale in [k for k in self._key_cache if k[1] == room_id]:
+                del self._key_cache[stale]
+
+    def cache_stats(self):
+        """返回密钥缓存的命中统计"""
+        with self._key_cache_lock:
+            return {
+                'size': len(self._key_cache),
+                'max_size': self.key_cache_size,
+                'hits': self.cache_hits,
+                'misses': self.cache_misses
+            }
 
     def generate_room_keypair(self):
         """生成新的RSA密钥对"""
+        return generate_rsa_keypair()
+
+    def new_room_key(self, public_key_pem, room_id=None):
+        """生成聊天室对称密钥，并用聊天室公钥封装"""
         try:
-            # 生成私钥
-            private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=2048
-            )
-            
-            # 获取公钥
-            public_key = private_key.public_key()
-            
-            # 序列化私钥
-            private_pem = private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            )
-            
-            # 序列化公钥
-            public_pem = public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-            
+            room_key = AESGCM.generate_key(bit_length=256)
+            public_key = self._load_public_key(public_key_pem, room_id)
+            wrapped = public_key.encrypt(room_key, self.padding)
+            wrapped_key = base64.b64encode(wrapped).decode('utf-8')
+
+            # 直接写入缓存，避免之后再做一次RSA解密
+            self._cached_key('room', room_id, wrapped_key, lambda _: room_key)
             return {
-                'private_key': private_pem.decode('utf-8'),
-                'public_key': public_pem.decode('utf-8')
+                'key': room_key,
+                'wrapped_key': wrapped_key
             }
         except Exception as e:
-            print(f"生成密钥对时出错: {str(e)}")
+            logger.error("生成聊天室密钥时出错: %s", e)
+            return None
+
+    def unwrap_room_key(self, wrapped_key, private_key_pem, room_id=None):
+        """使用聊天室私钥解封对称密钥，每个密钥只做一次RSA解密"""
+        def unwrap(data):
+            private_key = self._load_private_key(private_key_pem, room_id)
+            return private_key.decrypt(
+                base64.b64decode(data.encode('utf-8')),
+                self.padding
+            )
+        return self._cached_key('room', room_id, wrapped_key, unwrap)
+
+    @staticmethod
+    def message_key_version(encrypted_data_str):
+        """返回 v2 消息使用的密钥版本，旧格式消息返回 None"""
+        if not encrypted_data_str or not encrypted_data_str.startswith(MESSAGE_FORMAT_V2 + ':'):
             return None
+        return int(encrypted_data_str.split(':', 2)[1])
 
-    def encrypt_message(self, message, public_key_pem):
-        """使用公钥加密消息"""
+    @CRYPTO_SECONDS.time(operation='encrypt')
+    def encrypt_message(self, message, public_key_pem, room_key=None, room_id=None):
+        """加密消息
+
+        提供 room_key（{'version': int, 'key': bytes}）时使用 AES-GCM 生成 v2 格式，
+        否则回退到旧的 RSA-OAEP 格式（单条消息约 190 字节上限）。
+        """
         try:
-            if not message or not public_key_pem:
-                print("消息或公钥为空")
+            if not message:
+                logger.warning("消息为空")
+                return None
+
+            if room_key is not None:
+                header = f"{MESSAGE_FORMAT_V2}:{room_key['version']}"
+                nonce = os.urandom(NONCE_SIZE)
+                encrypted = AESGCM(room_key['key']).encrypt(
+                    nonce,
+                    message.encode('utf-8'),
+                    header.encode('utf-8')
+                )
+                return f"{header}:{base64.b64encode(nonce + encrypted).decode('utf-8')}"
+
+            if not public_key_pem:
+                logger.warning("公钥为空")
                 return None
                 
-            # 加载公钥
-            public_key = load_pem_public_key(public_key_pem.encode('utf-8'))
+            # 加载公钥（按聊天室缓存）
+            public_key = self._load_public_key(public_key_pem, room_id)
             
             # 加密消息
             encrypted = public_key.encrypt(
@@ -65,21 +206,39 @@ class ChatRoomCrypto:
             return base64.b64encode(encrypted).decode('utf-8')
             
         except Exception as e:
-            print(f"加密消息时出错: {str(e)}")
+            logger.error("加密消息时出错: %s", e)
             return None
 
-    def decrypt_message(self, encrypted_data_str, private_key_pem):
-        """使用私钥解密消息"""
+    @CRYPTO_SECONDS.time(operation='decrypt')
+    def decrypt_message(self, encrypted_data_str, private_key_pem, wrapped_keys=None, room_id=None):
+        """解密消息
+
+        wrapped_keys 为 {密钥版本: 封装后的对称密钥}，用于解密 v2 格式消息；
+        没有版本前缀的旧消息仍使用私钥直接解密。
+        """
         try:
             if not encrypted_data_str or not private_key_pem:
-                print("加密数据或私钥为空")
+                logger.warning("加密数据或私钥为空")
                 return None
+
+            key_version = self.message_key_version(encrypted_data_str)
+            if key_version is not None:
+                wrapped_key = (wrapped_keys or {}).get(key_version)
+                if not wrapped_key:
+                    logger.warning("缺少版本 %s 的聊天室密钥", key_version)
+                    return None
+                room_key = self.unwrap_room_key(wrapped_key, private_key_pem, room_id)
+                header, payload = encrypted_data_str.rsplit(':', 1)
+                raw = base64.b64decode(payload.encode('utf-8'))
+                decrypted = AESGCM(room_key).decrypt(
+                    raw[:NONCE_SIZE],
+                    raw[NONCE_SIZE:],
+                    header.encode('utf-8')
+                )
+                return decrypted.decode('utf-8')
                 
-            # 加载私钥
-            private_key = load_pem_private_key(
-                private_key_pem.encode('utf-8'),
-                password=None
-            )
+            # 加载私钥（按聊天室缓存）
+            private_key = self._load_private_key(private_key_pem, room_id)
             
             # 解码Base64数据
             encrypted_data = base64.b64decode(encrypted_data_str.encode('utf-8'))
@@ -93,5 +252,5 @@ class ChatRoomCrypto:
             return decrypted.decode('utf-8')
             
         except Exception as e:
-            print(f"解密消息时出错: {str(e)}")
+            logger.warning("解密消息时出错: %s", e)
             return None 
\ No newline at end of file
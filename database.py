@@ -1,16 +1,141 @@
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from datetime import datetime
+from flask_migrate import Migrate, upgrade, stamp
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
+from datetime import datetime, timedelta
 import redis
-import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from log_config import get_logger
+from metrics import REDIS_PUBLISH_SECONDS, REDIS_PUBLISHED_BYTES, REMOTE_IDENTITY_COLLISIONS
+import wire
+
+logger = get_logger('database')
 
 db = SQLAlchemy()
 migrate = Migrate()
 
+# SQLite 连接参数，每个新连接建立时通过 PRAGMA 设置
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # 读不阻塞写，写不阻塞读
+    # FULL：每次提交都 fsync；NORMAL：WAL 模式下只在检查点时 fsync，断电可能丢失最近提交的事务。
+    # 默认与 CHAT_DURABILITY 一致：sync（每条消息落盘）用 FULL，group 用 NORMAL
+    'synchronous': os.environ.get(
+        'SQLITE_SYNCHRONOUS', 'FULL' if os.environ.get('CHAT_DURABILITY', 'sync') == 'sync' else 'NORMAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', -64000)),  # 负数单位为 KiB
+    'temp_store': 'MEMORY',
+}
+
+def normalize_database_uri(uri):
+    """兼容 postgres:// 形式的连接串"""
+    if uri.startswith('postgres://'):
+        return 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+def engine_options(uri):
+    """按数据库类型返回 SQLAlchemy 引擎和连接池参数"""
+    if uri.startswith('sqlite'):
+        if ':memory:' in uri or uri in ('sqlite://', 'sqlite:///'):
+            return {}
+        return {
+            'poolclass': QueuePool,
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_timeout': 30,
+            'connect_args': {
+                'check_same_thread': False,
+                'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000,
+            },
+        }
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 30,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': True,
+    }
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """为每个新的 SQLite 连接设置 WAL 等参数，其他数据库不处理"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# 引入迁移之前用 db.create_all() 建的库对应的版本
+BASELINE_REVISION = '0001'
+
+def prepare_database():
+    """按需执行数据库迁移，已是最新版本时不做任何修改（需在应用上下文中调用）
+
+    返回是否执行了迁移。
+    """
+    config = migrate.get_config(MIGRATIONS_DIR)
+    head = ScriptDirectory.from_config(config).get_current_head()
+    with db.engine.connect() as connection:
+        current = MigrationContext.configure(connection).get_current_revision()
+        inspector = inspect(connection)
+        has_tables = inspector.has_table('users')
+        matches_models = has_tables and schema_matches_models(inspector)
+
+    if current == head:
+        return False
+    if current is None and matches_models:
+        # 按当前模型 create_all 建的库（如 migrate_to_postgres.py 的目标库）已是最新结构
+        stamp(directory=MIGRATIONS_DIR, revision=head)
+        return True
+    if current is None and has_tables:
+        # 旧版本启动时建的表，先标记为基线版本再升级
+        stamp(directory=MIGRATIONS_DIR, revision=BASELINE_REVISION)
+    upgrade(directory=MIGRATIONS_DIR)
+    return True
+
+def schema_matches_models(inspector):
+    """数据库中是否已有当前模型的所有表和列"""
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            return False
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        if not set(table.columns.keys()) <= columns:
+            return False
+    return True
+
+def configure_database(app, default_uri='sqlite:///site.db'):
+    """设置数据库连接串和引擎参数，需在 db.init_app 之前调用"""
+    uri = normalize_database_uri(os.environ.get('DATABASE_URL', default_uri))
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(uri)
+
+# 显式的连接池：限制连接数，并为连接和读写设置超时，Redis 不可用时调用方很快失败而不是长时间阻塞
 try:
-    redis_client = redis.Redis(host='localhost', port=6379, db=0)
+    redis_pool = redis.ConnectionPool(
+        host=os.environ.get('REDIS_HOST', 'localhost'),
+        port=int(os.environ.get('REDIS_PORT', 6379)),
+        db=int(os.environ.get('REDIS_DB', 0)),
+        max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)),
+        socket_connect_timeout=float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2)),
+        socket_timeout=float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5)),
+        health_check_interval=30
+    )
+    redis_client = redis.Redis(connection_pool=redis_pool)
 except:
-    print("Warning: Redis connection failed")
+    logger.warning("Redis connection failed")
     redis_client = None
 
 class User(db.Model):
@@ -49,6 +174,15 @@ class Post(db.Model):
     date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     host_id = db.Column(db.String(50), default='default')  # 修改这里
+    # 全局唯一动态ID，用于跨实例去重
+    post_uid = db.Column(db.String(64), nullable=False, default=lambda: uuid.uuid4().hex)
+
+    # 首页和个人主页按时间倒序分页
+    __table_args__ = (
+        db.Index('idx_post_date', date_posted, id),
+        db.Index('idx_post_user_date', user_id, date_posted, id),
+        db.Index('idx_post_uid', post_uid, unique=True),
+    )
 
     def to_dict(self):
         return {
@@ -58,7 +192,10 @@ class Post(db.Model):
             'date_posted': self.date_posted.strftime('%Y-%m-%d %H:%M:%S'),
             'user_id': self.user_id,
             'host_id': self.host_id,
-            'username': self.author.username
+            'post_uid': self.post_uid,
+            'username': self.author.username,
+            # 作者在本地保存的 host_id，跨重启不变；host_id 是发帖实例本次启动的 HOST_ID
+            'author_host': self.author.host_id
         }
 
 # 添加聊天室成员关联表
@@ -86,6 +223,9 @@ class ChatRoom(db.Model):
                             cascade='all, delete')
     messages = db.relationship('ChatMessage', backref='room', lazy=True, 
                              cascade='all, delete-orphan')
+    keys = db.relationship('ChatRoomKey', backref='room', lazy=True,
+                         order_by='ChatRoomKey.version',
+                         cascade='all, delete-orphan')
 
     def to_dict(self):
         return {
@@ -99,6 +239,86 @@ class ChatRoom(db.Model):
             'public_key': self.public_key
         }
 
+# 聊天室对称密钥（用聊天室公钥封装），按版本轮换
+class ChatRoomKey(db.Model):
+    __tablename__ = 'chatroom_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer, db.ForeignKey('chatrooms.id', ondelete='CASCADE'), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    wrapped_key = db.Column(db.Text, nullable=False)  # RSA-OAEP 封装后的 Base64 密钥
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('room_id', 'version', name='uq_room_key_version'),
+    )
+
+# 预生成但尚未使用的聊天室RSA密钥对，进程退出时保存，启动时取回密钥池
+class SpareRoomKey(db.Model):
+    __tablename__ = 'spare_room_keys'
+    id = db.Column(db.Integer, primary_key=True)
+    public_key = db.Column(db.Text, nullable=False)
+    private_key = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def claim_spare_room_keys(limit):
+    """取出并删除最多 limit 个备用密钥对，多个进程同时取时每个密钥只会被一个进程拿到"""
+    claimed = []
+    for spare in SpareRoomKey.query.order_by(SpareRoomKey.id).limit(limit).all():
+        deleted = db.session.query(SpareRoomKey).filter_by(id=spare.id).delete(synchronize_session=False)
+        if deleted:
+            claimed.append({'public_key': spare.public_key, 'private_key': spare.private_key})
+    db.session.commit()
+    return claimed
+
+def store_spare_room_keys(keys):
+    """保存未使用的密钥对"""
+    db.session.add_all(SpareRoomKey(public_key=k['public_key'], private_key=k['private_key']) for k in keys)
+    db.session.commit()
+
+# 待发布到 Redis 的消息，与产生它的动态或聊天消息在同一事务中写入，由后台线程发布后删除
+class OutboxMessage(db.Model):
+    __tablename__ = 'outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(200), nullable=False)
+    message_type = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)  # wire.encode 的结果
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # 认领这条消息的发布者和租约到期时间；发布者崩溃或发布失败后，租约到期的消息可以被重新认领
+    claimed_by = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+
+def add_outbox_entries(entries):
+    """在当前事务中写入发件箱，随调用方一起提交"""
+    if entries:
+        db.session.execute(OutboxMessage.__table__.insert(), entries)
+
+def claim_outbox_batch(limit, lease_seconds):
+    """按写入顺序认领最多 limit 条未被认领或租约已过期的消息并返回
+
+    认领是一条带条件的 UPDATE：多个进程（如集群中的工作进程）同时认领时，每条消息只会被其中一个拿到。
+    """
+    now = datetime.utcnow()
+    claimable = db.or_(OutboxMessage.claimed_until.is_(None), OutboxMessage.claimed_until < now)
+    candidates = db.select(OutboxMessage.id).where(claimable).order_by(OutboxMessage.id).limit(limit)
+    token = uuid.uuid4().hex
+    db.session.query(OutboxMessage)\
+        .filter(OutboxMessage.id.in_(candidates), claimable)\
+        .update({OutboxMessage.claimed_by: token,
+                 OutboxMessage.claimed_until: now + timedelta(seconds=lease_seconds)},
+                synchronize_session=False)
+    db.session.commit()
+    return db.session.query(OutboxMessage.id, OutboxMessage.channel, OutboxMessage.message_type,
+                            OutboxMessage.payload)\
+        .filter(OutboxMessage.claimed_by == token).order_by(OutboxMessage.id).all()
+
+def release_outbox_entries(ids):
+    """放弃认领（发布失败），下次重试时不必等租约到期"""
+    db.session.query(OutboxMessage).filter(OutboxMessage.id.in_(ids))\
+        .update({OutboxMessage.claimed_by: None, OutboxMessage.claimed_until: None}, synchronize_session=False)
+
+def delete_outbox_entries(ids):
+    db.session.query(OutboxMessage).filter(OutboxMessage.id.in_(ids)).delete(synchronize_session=False)
+
 # 修改 ChatMessage 模型，添加聊天室关联
 class ChatMessage(db.Model):
     __tablename__ = 'chat_messages'
@@ -108,15 +328,19 @@ class ChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('chatrooms.id', ondelete='CASCADE'), nullable=False)
     host_id = db.Column(db.String(50), default='default')
+    # 全局唯一消息ID，用于跨实例去重
+    message_uid = db.Column(db.String(64), nullable=False, default=lambda: uuid.uuid4().hex)
 
     # 添加索引以提高查询性能
     __table_args__ = (
         db.Index('idx_room_timestamp', room_id, timestamp),
+        db.Index('idx_message_uid', message_uid, unique=True),
     )
 
     def to_dict(self):
         return {
             'id': self.id,
+            'message_uid': self.message_uid,
             'content': self.content,
             'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
             'user_id': self.user_id,
@@ -125,50 +349,313 @@ class ChatMessage(db.Model):
             'username': self.author.username if self.author else 'Unknown'
         }
 
+class RoomMembership:
+    """聊天室成员检查：基于 chatroom_members 主键的存在性查询，加上每个聊天室的成员ID缓存
+
+    应用中成员只会增加不会移除，因此只缓存查询确认过的成员，缓存不会过期失效；
+    非成员每次都走一次主键查询，保证其他实例的邀请能立即生效。
+    """
+
+    def __init__(self):
+        self._members = {}  # {room_id: {user_id}}
+        self._lock = threading.Lock()
+
+    def is_member(self, room_id, user_id):
+        """判断用户是否为聊天室成员，代价与聊天室人数无关"""
+        room_id, user_id = int(room_id), int(user_id)
+        with self._lock:
+            if user_id in self._members.get(room_id, ()):
+                return True
+
+        found = db.session.query(
+            db.exists().where(db.and_(
+                chatroom_members.c.room_id == room_id,
+                chatroom_members.c.user_id == user_id
+            ))
+        ).scalar()
+        if found:
+            self.remember(room_id, [user_id])
+        return found
+
+    def add_member(self, room_id, user_id):
+        """在当前会话中添加成员关系，提交后需调用 remember 更新缓存"""
+        db.session.execute(chatroom_members.insert().values(room_id=room_id, user_id=user_id))
+
+    def member_ids_query(self, room_id):
+        """聊天室成员ID子查询，用于 IN / NOT IN 过滤"""
+        return db.session.query(chatroom_members.c.user_id)\
+            .filter(chatroom_members.c.room_id == room_id)
+
+    def remember(self, room_id, user_ids):
+        """记录已确认（或已提交）的成员"""
+        with self._lock:
+            self._members.setdefault(int(room_id), set()).update(int(u) for u in user_ids)
+
+    def invalidate(self, room_id=None):
+        """清除某个聊天室或全部聊天室的成员缓存"""
+        with self._lock:
+            if room_id is None:
+                self._members.clear()
+            else:
+                self._members.pop(int(room_id), None)
+
+room_membership = RoomMembership()
+
+def insert_ignore_duplicates(table, rows, index_elements=None):
+    """批量插入，与唯一约束冲突的行直接跳过（INSERT ... ON CONFLICT DO NOTHING）
+
+    index_elements 为空时任何唯一约束冲突都跳过。返回实际插入的行数（驱动不支持时为 -1）。
+    其他数据库没有 ON CONFLICT，改为逐行插入，见 insert_each_ignore_duplicates。
+    """
+    if not rows:
+        return 0
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return insert_each_ignore_duplicates(table, rows)
+
+    stmt = insert(table).on_conflict_do_nothing(index_elements=index_elements)
+    result = db.session.execute(stmt, rows)
+    return result.rowcount
+
+def insert_each_ignore_duplicates(table, rows):
+    """逐行在保存点中插入，违反约束（IntegrityError）的行回滚到保存点后跳过，返回插入的行数
+
+    适用于任何支持 SAVEPOINT 的数据库，但每行一次往返，比 ON CONFLICT 慢。
+    """
+    inserted = 0
+    for row in rows:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(table.insert(), row)
+            inserted += 1
+        except IntegrityError:
+            pass
+    return inserted
+
+def insert_messages_ignore_duplicates(rows):
+    """批量插入聊天消息，message_uid 已存在的行直接跳过，去重只走 idx_message_uid 唯一索引"""
+    return insert_ignore_duplicates(ChatMessage.__table__, rows, ['message_uid'])
+
+def insert_posts_ignore_duplicates(rows):
+    """批量插入动态，post_uid 已存在的行直接跳过"""
+    return insert_ignore_duplicates(Post.__table__, rows, ['post_uid'])
+
+class RemoteIdentityMap:
+    """把其他实例的用户 (username, host_id) 映射为本地用户ID，映射结果缓存在进程内
+
+    host_id 是用户在来源实例 users 表中保存的 host_id（消息中的 author_host），来源实例重启后不变。
+    用户名在本地唯一，优先匹配 (username, host_id)，否则按用户名匹配。本地没有的用户批量插入。
+    按用户名匹配说明两个实例有同名的不同用户（例如都使用默认端口的 user_port_5001），
+    或来源实例是没有发送 author_host 的旧版本；此时远程用户的内容会算到本地同名用户名下，
+    这类映射会记录警告并计入 remote_identity_collisions_total，需要区分时请为各实例配置不同的 PORT。
+    """
+
+    def __init__(self):
+        self._ids = {}  # {(username, host_id): 本地用户ID}
+        self._lock = threading.Lock()
+
+    def resolve(self, users):
+        """users 为 {(username, host_id): 用户字段}，返回 {(username, host_id): 本地用户ID}
+
+        需在应用上下文中调用，新插入的用户随调用方的事务提交。
+        """
+        with self._lock:
+            resolved = {identity: self._ids[identity] for identity in users if identity in self._ids}
+        missing = {identity: fields for identity, fields in users.items() if identity not in resolved}
+        if not missing:
+            return resolved
+
+        found = self._lookup(missing)
+        new_rows = [fields for identity, fields in missing.items() if identity not in found]
+        if new_rows:
+            insert_ignore_duplicates(User.__table__, new_rows)
+            found.update(self._lookup({identity: missing[identity] for identity in missing
+                                       if identity not in found}))
+
+        with self._lock:
+            self._ids.update(found)
+        resolved.update(found)
+        return resolved
+
+    @staticmethod
+    def _lookup(identities):
+        """一次查询按用户名（idx_username_host 前缀）找出本地用户"""
+        rows = db.session.query(User.id, User.username, User.host_id)\
+            .filter(User.username.in_({username for username, _ in identities})).all()
+        exact = {(row.username, row.host_id): row.id for row in rows}
+        by_name = {row.username: row.id for row in rows}
+        found = {}
+        hosts = {row.username: row.host_id for row in rows}
+        for identity in identities:
+            local_id = exact.get(identity)
+            if local_id is None and identity[0] in by_name:
+                local_id = by_name[identity[0]]
+                # 映射结果会被缓存，每个远程身份只记录一次
+                logger.warning("远程用户 %s（主机 %s）按用户名映射到本地用户 %s（主机 %s）",
+                               identity[0], identity[1], local_id, hosts[identity[0]])
+                REMOTE_IDENTITY_COLLISIONS.inc()
+            if local_id is not None:
+                found[identity] = local_id
+        return found
+
+    def invalidate(self):
+        with self._lock:
+            self._ids.clear()
+
+remote_identities = RemoteIdentityMap()
+
+FORUM_CHANNEL = 'forum_channel'
+# BROKER_TRANSPORT=streams 时所有消息写入的 Redis Stream
+FORUM_STREAM = f'{FORUM_CHANNEL}:stream'
+
 class MessageBroker:
-    def __init__(self, redis_client):
+    # auto 模式下重新检查各实例是否都支持二进制格式的间隔（秒）
+    WIRE_CHECK_INTERVAL = 30
+
+    def __init__(self, redis_client, chat_shards=0, wire_format='json',
+                 transport='pubsub', stream_maxlen=100000):
         self.redis = redis_client
+        # pubsub：即发即弃；streams：XADD 到 FORUM_STREAM，离线的实例重启后可以补读，
+        # 超过 stream_maxlen 条（近似）的旧消息会被裁剪
+        self.transport = transport
+        self.stream_maxlen = stream_maxlen
+        # 0 表示每个聊天室一个频道，大于 0 时按房间ID哈希到固定数量的分片频道
+        self.chat_shards = chat_shards
+        # json | binary | auto，见 wire.py
+        if wire_format != 'json' and not wire.binary_supported():
+            logger.warning("未安装 msgpack，WIRE_FORMAT=%s 回退为 json", wire_format)
+            wire_format = 'json'
+        self.wire_format = wire_format
+        self._binary = wire_format == 'binary'
+        self._binary_checked_at = None
         if self.redis:
             self.pubsub = self.redis.pubsub()
-        
-    def publish_post(self, post):
-        if not self.redis:
+
+    def use_binary(self):
+        """当前是否发布二进制格式；auto 模式下按订阅数判断所有实例是否都能解码"""
+        if self.wire_format != 'auto':
+            return self._binary
+        now = time.monotonic()
+        if self._binary_checked_at is None or now - self._binary_checked_at >= self.WIRE_CHECK_INTERVAL:
+            self._binary_checked_at = now
+            try:
+                counts = dict(self.redis.pubsub_numsub(FORUM_CHANNEL, wire.WIRE_CAPABILITY_CHANNEL))
+                subscribers = counts.get(FORUM_CHANNEL.encode('utf-8'), counts.get(FORUM_CHANNEL, 0))
+                capable = counts.get(wire.WIRE_CAPABILITY_CHANNEL.encode('utf-8'),
+                                     counts.get(wire.WIRE_CAPABILITY_CHANNEL, 0))
+                self._binary = subscribers > 0 and capable >= subscribers
+            except Exception as e:
+                logger.warning("检查实例消息格式支持情况失败: %s", e)
+                self._binary = False
+        return self._binary
+
+    def chat_channel(self, room_id):
+        """聊天消息所在的 Redis 频道"""
+        if self.chat_shards > 0:
+            shard = zlib.crc32(str(room_id).encode('utf-8')) % self.chat_shards
+            return f'{FORUM_CHANNEL}:chat:shard:{shard}'
+        return f'{FORUM_CHANNEL}:chat:room:{room_id}'
+
+    def encode(self, channel, message):
+        """编码一条待发布的消息，返回发件箱行 {'channel', 'message_type', 'payload', 'created_at'}
+
+        带上发布时间（epoch 秒），订阅端据此计算传输延迟；使用发件箱时该时间为写入发件箱的时间。
+        在请求路径上调用，不访问 Redis：auto 模式下先编码为 json，由 publish_entries 决定是否转为 binary。
+        """
+        message['published_at'] = time.time()
+        return {
+            'channel': channel,
+            'message_type': message['type'],
+            'payload': wire.encode(message, binary=self.wire_format == 'binary'),
+            'created_at': datetime.utcnow()
+        }
+
+    def _wire_payload(self, payload, binary):
+        """auto 模式下按发布时的判断把 json 消息转为 binary"""
+        if binary and not wire.is_binary(payload):
+            return wire.encode(wire.decode(payload), binary=True)
+        return payload
+
+    def publish_entries(self, entries):
+        """用一个管道发布一批已编码的消息，失败时抛出异常"""
+        if not entries:
             return
-        message = {
+        binary = self.use_binary()
+        payloads = [self._wire_payload(entry['payload'], binary) for entry in entries]
+        pipeline = self.redis.pipeline(transaction=False)
+        for entry, payload in zip(entries, payloads):
+            if self.transport == 'streams':
+                pipeline.xadd(FORUM_STREAM, {'m': payload},
+                              maxlen=self.stream_maxlen or None, approximate=True)
+            else:
+                pipeline.publish(entry['channel'], payload)
+        label = entries[0]['message_type'] if len(entries) == 1 else 'batch'
+        with REDIS_PUBLISH_SECONDS.time(type=label):
+            pipeline.execute()
+        for entry, payload in zip(entries, payloads):
+            REDIS_PUBLISHED_BYTES.inc(len(payload), type=entry['message_type'],
+                                      format='binary' if wire.is_binary(payload) else 'json')
+
+    def _publish(self, channel, message):
+        self.publish_entries([self.encode(channel, message)])
+
+    def post_message(self, post):
+        """动态的 (频道, 消息)"""
+        return FORUM_CHANNEL, {
             'type': 'post',
             'data': post.to_dict()
         }
-        self.redis.publish('forum_channel', json.dumps(message))
-        
-    def publish_chat(self, chat_message):
-        if not self.redis:
-            return
-        message = {
+
+    def chat_message(self, chat_message, username=None, author_host=None):
+        """聊天消息的 (频道, 消息)；消息尚未写入数据库时需传入发送者用户名和发送者的 users.host_id"""
+        return self.chat_channel(chat_message.room_id), {
             'type': 'chat',
             'data': {
                 'id': chat_message.id,
+                'message_uid': chat_message.message_uid,
                 'content': chat_message.content,  # 已加密的消息内容
                 'user_id': chat_message.user_id,
                 'room_id': chat_message.room_id,
                 'host_id': chat_message.host_id,
-                'username': chat_message.author.username,
-                'timestamp': chat_message.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+                'username': username or chat_message.author.username,
+                'author_host': author_host or chat_message.author.host_id,
+                'timestamp': chat_message.timestamp
             }
         }
+
+    def user_message(self, user):
+        """用户信息的 (频道, 消息)"""
+        return FORUM_CHANNEL, {
+            'type': 'user',
+            'data': user.to_dict()
+        }
+        
+    def publish_post(self, post):
+        if not self.redis:
+            return
+        self._publish(*self.post_message(post))
+        
+    def publish_chat(self, chat_message, username=None, author_host=None):
+        """同步发布聊天消息（未启用发件箱时使用）"""
+        if not self.redis:
+            return
         try:
-            self.redis.publish('forum_channel', json.dumps(message))
-            print(f"加密消息已发布到Redis")
+            self._publish(*self.chat_message(chat_message, username, author_host))
         except Exception as e:
-            print(f"发布消息到Redis时出错: {e}")
+            logger.warning("发布消息到Redis时出错: %s", e)
         
     def publish_user(self, user):
         if not self.redis:
             return
-        message = {
-            'type': 'user',
-            'data': user.to_dict()
-        }
-        self.redis.publish('forum_channel', json.dumps(message))
+        self._publish(*self.user_message(user))
 
-message_broker = MessageBroker(redis_client)
+message_broker = MessageBroker(redis_client,
+                               chat_shards=int(os.environ.get('CHAT_SHARDS', 0)),
+                               wire_format=os.environ.get('WIRE_FORMAT', 'json'),
+                               transport=os.environ.get('BROKER_TRANSPORT', 'pubsub'),
+                               stream_maxlen=int(os.environ.get('STREAM_MAXLEN', 100000)))
 
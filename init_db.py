@@ -1,15 +1,23 @@
-from app import app, db
-from database import User, Post, ChatMessage
-
-def init_db():
-    with app.app_context():
-        # 删除所有表
-        db.drop_all()
-        print("已删除所有表")
-        
-        # 创建所有表
-        db.create_all()
-        print("已创建新表")
+import sys
+
+from app import app, db, init_database, invalidate_current_user
+from database import room_membership, remote_identities
+
+def init_db(reset=False):
+    """执行数据库迁移；reset=True 时先删除所有表（会丢失全部数据）"""
+    if reset:
+        with app.app_context():
+            # 删除所有表
+            db.drop_all()
+            db.session.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+            db.session.commit()
+            invalidate_current_user()
+            room_membership.invalidate()
+            remote_identities.invalidate()
+            print("已删除所有表")
+
+    # 按需迁移并创建当前用户
+    init_database()
 
 if __name__ == '__main__':
-    init_db() 
\ No newline at end of file
+    init_db(reset='--reset' in sys.argv[1:])
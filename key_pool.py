@@ -0,0 +1,124 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
+import time
+
+from log_config import get_logger
+
+logger = get_logger('key_pool')
+
+
+def _lower_priority():
+    """进程池初始化：降低生成密钥的进程优先级，CPU 优先留给处理连接的进程"""
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+class RoomKeyPool:
+    """预生成的聊天室 RSA 密钥对池
+
+    后台线程把池子补充到 size 个密钥对，密钥在低优先级的进程池中生成（processes=0 时
+    交给 offload 在线程中生成）；take 直接从池中取出，池空时才在调用方同步生成。
+    进程退出前由调用方取出剩余密钥（drain）保存，下次启动时用 add 放回池中。
+    """
+
+    def __init__(self, generate, size=8, processes=1, offload=None):
+        self.generate = generate  # 需为模块级函数，才能在进程池中执行
+        self.size = max(0, size)
+        self.processes = processes
+        self.offload = offload or (lambda fn, *args, **kwargs: fn(*args, **kwargs))
+        self._keys = deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._stopping = threading.Event()
+        self._executor = None
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def start(self):
+        """启动后台补充线程"""
+        if self.thread is not None or self.size == 0:
+            return
+        if self.processes > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=_lower_priority)
+        self.thread = threading.Thread(target=self._refill_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        self._wanted.set()
+
+    def add(self, keys):
+        """放入已有的密钥对（如上次退出时保存的备用密钥）"""
+        with self._lock:
+            self._keys.extend(keys)
+
+    def take(self):
+        """取出一个密钥对，池空时同步生成"""
+        with self._lock:
+            keys = self._keys.popleft() if self._keys else None
+            if keys is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self._wanted.set()
+        if keys is not None:
+            return keys
+        return self.offload(self.generate)
+
+    def drain(self):
+        """取出池中全部剩余密钥对"""
+        with self._lock:
+            keys = list(self._keys)
+            self._keys.clear()
+        return keys
+
+    def _generate_one(self):
+        if self._executor is not None:
+            # 在原生线程中等待进程池结果，协程模式下不阻塞事件循环
+            return self.offload(self._executor.submit(self.generate).result)
+        return self.offload(self.generate)
+
+    def _refill_loop(self):
+        while not self._stopping.is_set():
+            self._wanted.wait()
+            self._wanted.clear()
+            while not self._stopping.is_set():
+                with self._lock:
+                    if len(self._keys) >= self.size:
+                        break
+                try:
+                    keys = self._generate_one()
+                except Exception as e:
+                    logger.warning("预生成聊天室密钥失败: %s", e)
+                    keys = None
+                if keys is None:
+                    time.sleep(1)
+                    continue
+                with self._lock:
+                    self._keys.append(keys)
+                    self.generated += 1
+
+    def stop(self):
+        """停止后台补充，返回剩余的密钥对"""
+        self._stopping.set()
+        self._wanted.set()
+        if self.thread is not None:
+            self.thread.join(5)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        return self.drain()
+
+    def stats(self):
+        with self._lock:
+            available = len(self._keys)
+        return {
+            'size': self.size,
+            'available': available,
+            'hits': self.hits,
+            'misses': self.misses,
+            'generated': self.generated
+        }
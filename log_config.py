@@ -0,0 +1,75 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# 日志级别和格式通过环境变量配置：
+#   LOG_LEVEL=DEBUG|INFO|WARNING（默认 INFO）
+#   LOG_FORMAT=text|json（默认 text）
+#   LOG_SAMPLE_RATE=0.01  逐条消息事件（web3_social.message）在 DEBUG 级别下的采样率
+LOGGER_NAME = 'web3_social'
+
+_listener = None
+
+
+class SamplingFilter(logging.Filter):
+    """按比例采样日志，WARNING 及以上级别始终保留"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """配置应用日志：日志先进入内存队列，由后台线程写到 stderr，不阻塞请求线程"""
+    global _listener
+    if _listener is not None:
+        return
+
+    level = getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    if os.environ.get('LOG_FORMAT', 'text') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    app_logger = logging.getLogger(LOGGER_NAME)
+    app_logger.setLevel(level)
+    app_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    app_logger.propagate = False
+
+    message_logger = logging.getLogger(f'{LOGGER_NAME}.message')
+    message_logger.addFilter(SamplingFilter(float(os.environ.get('LOG_SAMPLE_RATE', 0.01))))
+
+
+def get_logger(name):
+    """获取应用日志记录器，name 如 'app'、'subscriber'；'message' 用于逐条消息事件（会被采样）"""
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
@@ -0,0 +1,215 @@
+import functools
+import math
+import threading
+import time
+
+# Prometheus 文本格式的轻量指标实现，通过 /metrics 暴露
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    body = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in pairs)
+    return '{' + body + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        return []
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in items]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；set_function 设置的回调在每次采集时调用"""
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """function() 返回 {标签值元组: 数值}，无标签时可直接返回数值"""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            items = list(values.items())
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in items]
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Timer(self.histogram, self.labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class Histogram(_Metric):
+    """按桶统计耗时分布，单位为秒"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}  # {标签值: [各桶计数, 总和, 次数]}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """计时，可用作 with 语句或装饰器"""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 消息生命周期各环节的指标
+CRYPTO_SECONDS = Histogram('chat_crypto_seconds', '聊天消息加解密耗时', ['operation'])
+DB_COMMIT_SECONDS = Histogram('db_commit_seconds', '数据库提交耗时', ['source'])
+EMIT_SECONDS = Histogram('socketio_emit_seconds', 'Socket.IO 广播耗时', ['source'])
+REDIS_PUBLISH_SECONDS = Histogram('redis_publish_seconds', 'Redis 发布耗时', ['type'])
+REDIS_PUBLISHED_BYTES = Counter('redis_published_bytes_total', '发布到 Redis 的消息字节数', ['type', 'format'])
+REDIS_SUBSCRIBE_LAG_SECONDS = Histogram('redis_subscribe_lag_seconds', '从发布到本实例收到的延迟', ['type'])
+DELIVERY_SECONDS = Histogram('chat_delivery_seconds', '跨实例端到端延迟：发布到远端广播完成')
+CHAT_MESSAGES = Counter('chat_messages_total', '聊天消息数', ['room', 'source'])
+SUBSCRIBER_QUEUE_DEPTH = Gauge('redis_subscriber_queue_depth', 'Redis 订阅工作队列深度', ['worker'])
+ROOM_ACTIVE_SOCKETS = Gauge('room_active_sockets', '本实例各聊天室的连接数', ['room'])
+CRYPTO_KEY_CACHE = Gauge('chat_crypto_key_cache', '密钥缓存：当前条目数、容量、累计命中和未命中次数', ['stat'])
+CHAT_WRITER_ROWS = Gauge('chat_writer_rows', '聊天消息后台写入：缓冲中、重试中、已写入、已丢弃的行数', ['state'])
+REMOTE_IDENTITY_COLLISIONS = Counter('remote_identity_collisions_total',
+                                     '按用户名映射到 host_id 不同的本地用户的远程用户数')
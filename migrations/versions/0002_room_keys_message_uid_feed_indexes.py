@@ -0,0 +1,53 @@
+"""room keys, message uid and feed indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chatroom_keys',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('room_id', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('wrapped_key', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['room_id'], ['chatrooms.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('room_id', 'version', name='uq_room_key_version')
+    )
+
+    # 已有消息使用 legacy-<id> 作为全局ID，之后再加非空约束和唯一索引
+    with op.batch_alter_table('chat_messages', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('message_uid', sa.String(length=64), nullable=True))
+    op.execute("UPDATE chat_messages SET message_uid = 'legacy-' || id WHERE message_uid IS NULL")
+    with op.batch_alter_table('chat_messages', schema=None) as batch_op:
+        batch_op.alter_column('message_uid', existing_type=sa.String(length=64), nullable=False)
+        batch_op.create_index('idx_message_uid', ['message_uid'], unique=True)
+
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.create_index('idx_post_date', ['date_posted', 'id'], unique=False)
+        batch_op.create_index('idx_post_user_date', ['user_id', 'date_posted', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index('idx_post_user_date')
+        batch_op.drop_index('idx_post_date')
+
+    with op.batch_alter_table('chat_messages', schema=None) as batch_op:
+        batch_op.drop_index('idx_message_uid')
+        batch_op.drop_column('message_uid')
+
+    op.drop_table('chatroom_keys')
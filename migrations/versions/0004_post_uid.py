@@ -0,0 +1,32 @@
+"""post uid
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 已有动态使用 legacy-post-<id> 作为全局ID，之后再加非空约束和唯一索引
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('post_uid', sa.String(length=64), nullable=True))
+    op.execute("UPDATE posts SET post_uid = 'legacy-post-' || id WHERE post_uid IS NULL")
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.alter_column('post_uid', existing_type=sa.String(length=64), nullable=False)
+        batch_op.create_index('idx_post_uid', ['post_uid'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('posts', schema=None) as batch_op:
+        batch_op.drop_index('idx_post_uid')
+        batch_op.drop_column('post_uid')
@@ -0,0 +1,83 @@
+import threading
+
+from log_config import get_logger
+
+logger = get_logger('outbox')
+
+
+class OutboxPublisher:
+    """把发件箱表中的消息发布到 Redis 的后台线程
+
+    消息与 Post / ChatMessage 在同一事务中写入发件箱，请求路径上不访问 Redis。
+    后台线程被 notify 唤醒（或每隔 poll_interval_ms 毫秒检查一次），每次调用
+    drain_batch(batch_size) 认领一批消息、用管道发布并删除，返回处理的条数；
+    每条消息只会被一个进程认领，集群中的每个工作进程都可以运行发布线程。
+    发布失败时按指数退避重试，消息留在发件箱中不会丢失。
+    """
+
+    def __init__(self, drain_batch, batch_size=200, poll_interval_ms=1000, max_backoff_ms=5000):
+        self.drain_batch = drain_batch
+        self.batch_size = max(1, batch_size)
+        self.poll_interval = poll_interval_ms / 1000.0
+        self.max_backoff = max_backoff_ms / 1000.0
+        self.thread = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self.published = 0
+        self.failures = 0
+
+    def start(self):
+        """启动后台发布线程"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self):
+        """有新消息写入发件箱（事务已提交）"""
+        self._wakeup.set()
+
+    def drain(self):
+        """发布发件箱中的全部消息，返回发布的条数；发布失败时抛出异常"""
+        total = 0
+        while True:
+            count = self.drain_batch(self.batch_size)
+            total += count
+            self.published += count
+            if count < self.batch_size:
+                return total
+
+    def _run(self):
+        backoff = 0.0
+        while not self._stopping.is_set():
+            if backoff:
+                # 退避期间 notify 不会提前唤醒，避免 Redis 不可用时每条新消息都触发一次重试
+                self._stopping.wait(backoff)
+            else:
+                self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.drain()
+                backoff = 0.0
+            except Exception as e:
+                self.failures += 1
+                backoff = min(self.max_backoff, max(0.1, backoff * 2))
+                logger.warning("发布发件箱消息失败，%.1f 秒后重试: %s", backoff, e)
+
+    def stop(self, timeout=5):
+        """停止后台线程，并尽量发布剩余消息（进程退出时调用）"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        try:
+            self.drain()
+        except Exception as e:
+            logger.warning("退出前发布发件箱消息失败，剩余消息将在下次启动后发布: %s", e)
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'failures': self.failures
+        }
@@ -0,0 +1,186 @@
+from collections import Counter
+import threading
+import time
+
+from log_config import get_logger
+from utils import TTLCache
+
+logger = get_logger('presence')
+
+PRESENCE_PREFIX = 'forum_channel:presence'
+
+
+class PresenceTracker:
+    """聊天室在线状态
+
+    本实例在内存中记录每个聊天室的在线用户（同一用户多个连接只算一次），
+    心跳任务每隔 heartbeat_interval 秒把各聊天室的在线用户写入 Redis 集合
+    presence:users:<实例ID>:<聊天室ID>，集合带 ttl 秒的过期时间；实例登记在有序集合
+    presence:instances 中（分数为最近一次心跳时间）。实例异常退出后它的数据在 ttl 秒内过期。
+
+    查询时对存活实例的集合取并集，同一用户连接在多个实例（如集群中的多个工作进程）只算一次；
+    多个聊天室在同一个管道中查询。其他实例的在线用户在内存中缓存，心跳任务刷新本实例有连接的聊天室，
+    页面渲染通常不访问 Redis；Redis 查询失败后 heartbeat_interval 秒内不再查询，这些聊天室的
+    在线人数为 None（未知）。没有 Redis 时只统计本实例。
+    """
+
+    def __init__(self, redis_client, instance_id, ttl=30, heartbeat_interval=10):
+        self.redis = redis_client
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self._rooms = {}  # {room_id: Counter(username -> 连接数)}
+        self._sockets = {}  # {(sid, room_id): username}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._published_rooms = set()
+        # 其他实例的在线用户 {room_id: {用户名}}，有效期覆盖两次心跳，心跳刷新时不会出现空档
+        self._remote = TTLCache(heartbeat_interval * 2)
+        self._redis_down_until = 0.0
+
+    def _users_key(self, instance_id, room_id):
+        return f'{PRESENCE_PREFIX}:users:{instance_id}:{room_id}'
+
+    def join(self, sid, room_id, username):
+        """连接加入聊天室，返回该用户是否刚上线（此前在本实例没有连接在该聊天室）"""
+        with self._lock:
+            if (sid, room_id) in self._sockets:
+                return False
+            self._sockets[(sid, room_id)] = username
+            users = self._rooms.setdefault(room_id, Counter())
+            users[username] += 1
+            return users[username] == 1
+
+    def leave(self, sid, room_id):
+        """连接离开聊天室，返回 (用户名, 是否已下线)；连接不在该聊天室时返回 (None, False)"""
+        with self._lock:
+            username = self._sockets.pop((sid, room_id), None)
+            if username is None:
+                return None, False
+            users = self._rooms[room_id]
+            users[username] -= 1
+            if users[username] > 0:
+                return username, False
+            del users[username]
+            if not users:
+                del self._rooms[room_id]
+            return username, True
+
+    def _snapshot(self):
+        with self._lock:
+            return {room_id: set(users) for room_id, users in self._rooms.items()}
+
+    def heartbeat(self):
+        """把本实例的在线用户写入 Redis 并刷新过期时间"""
+        if not self.redis:
+            return
+        rooms = self._snapshot()
+        now = time.time()
+        # 事务管道：其他实例不会读到先删除后写入之间的空集合
+        pipeline = self.redis.pipeline()
+        for room_id, users in rooms.items():
+            users_key = self._users_key(self.instance_id, room_id)
+            pipeline.delete(users_key)
+            pipeline.sadd(users_key, *users)
+            pipeline.expire(users_key, self.ttl)
+        # 本实例已经没有在线用户的聊天室
+        for room_id in self._published_rooms - set(rooms):
+            pipeline.delete(self._users_key(self.instance_id, room_id))
+        pipeline.zadd(f'{PRESENCE_PREFIX}:instances', {self.instance_id: now})
+        pipeline.zremrangebyscore(f'{PRESENCE_PREFIX}:instances', 0, now - self.ttl)
+        pipeline.execute()
+        self._published_rooms = set(rooms)
+        self._redis_down_until = 0.0
+        if rooms:
+            self._fetch_remote(list(rooms))
+
+    def _remote_instances(self):
+        """除本实例外心跳未过期的实例"""
+        instances = self.redis.zrangebyscore(f'{PRESENCE_PREFIX}:instances', time.time() - self.ttl, '+inf')
+        instances = [i.decode('utf-8') if isinstance(i, bytes) else i for i in instances]
+        return [i for i in instances if i != self.instance_id]
+
+    def _fetch_remote(self, room_ids):
+        """查询其他实例在这些聊天室的在线用户并缓存，不论聊天室数量只需两次 Redis 往返"""
+        remote = {room_id: set() for room_id in room_ids}
+        instances = self._remote_instances()
+        if instances:
+            pipeline = self.redis.pipeline(transaction=False)
+            for room_id in room_ids:
+                pipeline.sunion([self._users_key(instance, room_id) for instance in instances])
+            for room_id, users in zip(room_ids, pipeline.execute()):
+                remote[room_id].update(u.decode('utf-8') if isinstance(u, bytes) else u for u in users)
+        for room_id, users in remote.items():
+            self._remote.set(room_id, users)
+        return remote
+
+    def _remote_users(self, room_ids):
+        """其他实例的在线用户，优先使用缓存；Redis 不可用时返回 None"""
+        remote = {}
+        missing = []
+        for room_id in room_ids:
+            users = self._remote.get(room_id)
+            if users is None:
+                missing.append(room_id)
+            else:
+                remote[room_id] = users
+        if not missing:
+            return remote
+        if time.monotonic() < self._redis_down_until:
+            return None
+        try:
+            remote.update(self._fetch_remote(missing))
+        except Exception as e:
+            self._redis_down_until = time.monotonic() + self.heartbeat_interval
+            logger.warning("查询在线用户失败: %s", e)
+            return None
+        return remote
+
+    def online_users(self, room_ids):
+        """各聊天室的在线用户 {room_id: {用户名}}，无法得知其他实例的在线用户时为 None"""
+        room_ids = [str(room_id) for room_id in room_ids]
+        local = self._snapshot()
+        online = {room_id: set(local.get(room_id, ())) for room_id in room_ids}
+        if not self.redis or not room_ids:
+            return online
+        remote = self._remote_users(room_ids)
+        if remote is None:
+            return dict.fromkeys(room_ids)
+        for room_id in room_ids:
+            online[room_id] |= remote[room_id]
+        return online
+
+    def online_counts(self, room_ids):
+        """各聊天室的在线人数 {room_id: 人数}，无法得知时为 None"""
+        return {room_id: None if users is None else len(users)
+                for room_id, users in self.online_users(room_ids).items()}
+
+    def run_heartbeats(self, sleep):
+        """心跳循环，sleep 为 socketio.sleep"""
+        while not self._stopping.is_set():
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.warning("写入在线状态失败: %s", e)
+            sleep(self.heartbeat_interval)
+
+    def stop(self):
+        """停止心跳并删除本实例的在线状态，其他实例立即看到这些用户下线"""
+        self._stopping.set()
+        if not self.redis:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for room_id in self._published_rooms:
+                pipeline.delete(self._users_key(self.instance_id, room_id))
+            pipeline.zrem(f'{PRESENCE_PREFIX}:instances', self.instance_id)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning("清除在线状态失败: %s", e)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._rooms),
+                'sockets': len(self._sockets)
+            }
@@ -0,0 +1,32 @@
+"""生产环境入口：在协程服务器上运行，单进程可保持大量空闲 WebSocket 连接
+
+    ASYNC_MODE=eventlet PORT=5001 python server.py
+    ASYNC_MODE=gevent PORT=5001 python server.py
+
+猴子补丁必须在导入 app（以及 redis、threading 等）之前完成，
+这样 Redis 订阅线程和 redis-py 的网络 I/O 都会变成协程，不会阻塞事件循环。
+"""
+import os
+
+ASYNC_MODE = os.environ.setdefault('ASYNC_MODE', 'eventlet')
+
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+else:
+    raise SystemExit(f"server.py 只支持 eventlet 或 gevent，当前 ASYNC_MODE={ASYNC_MODE}")
+
+from app import main  # noqa: E402
+
+if __name__ == '__main__':
+    server_options = {}
+    if ASYNC_MODE == 'eventlet':
+        # eventlet.wsgi 默认最多 1024 个并发连接
+        server_options['max_size'] = int(os.environ.get('MAX_CONNECTIONS', 50000))
+    main(debug=False,
+         init_db=os.environ.get('INIT_DATABASE', '1') != '0',
+         log_output=False,
+         **server_options)
@@ -4,10 +4,19 @@ let messagesDiv;
 let messageInput;
 let messageHistory;
 let currentRoom;
+// 历史消息分页状态
+let historyCursor = null;
+let historyHasMore = false;
+let historyLoading = false;
+const HISTORY_PAGE_SIZE = 50;
+// 已显示的消息ID，实时消息和历史消息按 message_uid 合并
+const renderedMessageUids = new Set();
+let hasConnected = false;
 
 // 初始化函数
 function initializeChat() {
-    socket = io();
+    // 集群模式下服务端会要求只使用 websocket 传输
+    socket = io(window.SOCKETIO_OPTIONS || {});
     messagesDiv = document.getElementById('messages');
     messageInput = document.getElementById('message');
     
@@ -16,7 +25,6 @@ function initializeChat() {
     currentRoom = pathParts[pathParts.indexOf('chat') + 1];
     
     console.log('初始化聊天室 - 当前房间ID:', currentRoom);
-    console.log('历史消息:', window.CHAT_HISTORY);
 
     if (currentRoom) {
         setupSocketListeners();
@@ -28,33 +36,88 @@ function initializeChat() {
     }
 }
 
-// 加载历史消息
-function loadChatHistory() {
+// 请求一页历史消息，before 为空时获取最新一页
+function fetchHistoryPage(before) {
+    const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+    if (before) {
+        params.set('before', before);
+    }
+    return fetch(`${window.HISTORY_URL}?${params.toString()}`)
+        .then(response => response.json().then(body => {
+            if (!response.ok) {
+                throw new Error(body.error || '加载历史消息失败');
+            }
+            return body;
+        }));
+}
+
+// 加载最新一页历史消息，合并到已显示的消息中（不清空，加载期间收到的实时消息保留）
+// anchor 为插入位置之前的元素：首次加载为 null（插入到最前面），
+// 重连时为断线前的最后一条消息，断线期间错过的消息插入到它之后、重连后收到的实时消息之前
+function loadChatHistory(anchor = null) {
     if (!messagesDiv) {
         console.error('消息容器不存在');
         return;
     }
+    if (!window.HISTORY_URL) {
+        console.log('没有历史消息可加载');
+        return;
+    }
 
-    // 清空消息显示区域
-    messagesDiv.innerHTML = '';
-    
-    // 检查并加载历史消息
-    if (window.CHAT_HISTORY && Array.isArray(window.CHAT_HISTORY)) {
-        console.log('开始加载历史消息，共', window.CHAT_HISTORY.length, '条');
-        window.CHAT_HISTORY.forEach((data, index) => {
-            console.log(`加载第 ${index + 1} 条历史消息:`, data);
-            addMessage({
-                user: data.user,
-                message: data.message,
-                timestamp: data.timestamp
-            });
+    const initial = anchor === null;
+    if (initial) {
+        historyLoading = true;
+    }
+    fetchHistoryPage(null)
+        .then(page => {
+            const fragment = document.createDocumentFragment();
+            page.messages
+                .filter(data => !renderedMessageUids.has(data.message_uid))
+                .forEach(data => fragment.appendChild(createMessageElement(data)));
+            const before = anchor && anchor.parentNode === messagesDiv ? anchor.nextSibling : messagesDiv.firstChild;
+            messagesDiv.insertBefore(fragment, before);
+
+            if (initial) {
+                historyCursor = page.next_before;
+                historyHasMore = page.has_more;
+            }
+            // 滚动到最新消息
+            messagesDiv.scrollTop = messagesDiv.scrollHeight;
+            console.log('历史消息加载完成，共', page.messages.length, '条');
+        })
+        .catch(error => console.error('加载历史消息时出错:', error))
+        .finally(() => {
+            if (initial) {
+                historyLoading = false;
+            }
         });
-        // 滚动到最新消息
-        messagesDiv.scrollTop = messagesDiv.scrollHeight;
-        console.log('历史消息加载完成');
-    } else {
-        console.log('没有历史消息可加载');
+}
+
+// 向上滚动时加载更早的一页历史消息
+function loadOlderMessages() {
+    if (historyLoading || !historyHasMore || !historyCursor) {
+        return;
     }
+
+    historyLoading = true;
+    fetchHistoryPage(historyCursor)
+        .then(page => {
+            // 插入到顶部并保持当前可见位置不跳动
+            const previousHeight = messagesDiv.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            page.messages
+                .filter(data => !renderedMessageUids.has(data.message_uid))
+                .forEach(data => fragment.appendChild(createMessageElement(data)));
+            messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+            messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+
+            historyCursor = page.next_before;
+            historyHasMore = page.has_more;
+        })
+        .catch(error => console.error('加载更早的消息时出错:', error))
+        .finally(() => {
+            historyLoading = false;
+        });
 }
 
 // 发送消息函数
@@ -124,9 +187,6 @@ function joinRoom(roomId) {
     
     // 发送加入房间请求
     socket.emit('join', { room_id: roomId });
-    
-    // 加载历史消息
-    loadChatHistory();
 }
 
 // 初始化事件监听器
@@ -141,6 +201,15 @@ function initializeEventListeners() {
         });
     }
 
+    // 滚动到顶部附近时加载更早的消息
+    if (messagesDiv) {
+        messagesDiv.addEventListener('scroll', function() {
+            if (messagesDiv.scrollTop < 50) {
+                loadOlderMessages();
+            }
+        });
+    }
+
     // 发送按钮点击事件
     const sendBtn = document.querySelector('.chat-input-container button');
     if (sendBtn) {
@@ -156,10 +225,15 @@ function initializeEventListeners() {
 function setupSocketListeners() {
     socket.on('connect', () => {
         console.log('WebSocket 已连接');
-        // 重新加入房间
-        if (currentRoom) {
-            joinRoom(currentRoom);
+        if (!currentRoom) {
+            return;
+        }
+        // 重连后重新加入房间，并补上断线期间错过的消息
+        joinRoom(currentRoom);
+        if (hasConnected) {
+            loadChatHistory(messagesDiv ? messagesDiv.lastElementChild : null);
         }
+        hasConnected = true;
     });
 
     socket.on('message', (data) => {
@@ -167,11 +241,7 @@ function setupSocketListeners() {
         // 确保消息来自当前房间
         if (data.room_id && data.room_id.toString() === currentRoom.toString()) {
             console.log('添加消息到显示区域:', data);
-            addMessage({
-                user: data.user,
-                message: data.message,
-                timestamp: data.timestamp
-            });
+            addMessage(data);
             // 滚动到最新消息
             if (messagesDiv) {
                 messagesDiv.scrollTop = messagesDiv.scrollHeight;
@@ -181,6 +251,13 @@ function setupSocketListeners() {
         }
     });
 
+    // 服务端合并广播时，一个事件中带有同一房间的多条消息
+    socket.on('messages', (data) => {
+        if (data.room_id && data.room_id.toString() === currentRoom.toString()) {
+            addMessages(data.messages);
+        }
+    });
+
     socket.on('error', (data) => {
         console.error('收到错误消息:', data.message);
         // 启用输入框（如果被禁用）
@@ -197,6 +274,23 @@ function setupSocketListeners() {
         }
     });
 
+    // 合并后的在线状态变化：更新在线人数，并显示一条汇总的系统消息
+    socket.on('presence', (data) => {
+        document.querySelectorAll(`.online-count[data-room-id="${data.room_id}"]`).forEach(el => {
+            el.textContent = data.online ?? '?';  // null：暂时无法得知其他实例的在线用户
+        });
+        if (data.room_id && data.room_id.toString() === currentRoom.toString()) {
+            const parts = [];
+            if (data.joined) {
+                parts.push(describePresence(data.joined_names, data.joined, '加入了聊天室'));
+            }
+            if (data.left) {
+                parts.push(describePresence(data.left_names, data.left, '离开了聊天室'));
+            }
+            addSystemMessage(parts.join('；'), data.timestamp);
+        }
+    });
+
     socket.on('disconnect', () => {
         console.log('WebSocket 已断开');
         // 启用输入框（如果被禁用）
@@ -222,31 +316,56 @@ function addSystemMessage(message, timestamp) {
     messagesDiv.scrollTop = messagesDiv.scrollHeight;
 }
 
-// 添加消息到显示区域
-function addMessage(data) {
+// 在线状态描述，例如 "alice、bob 等 37 人加入了聊天室"
+function describePresence(names, count, action) {
+    const shown = names.join('、');
+    if (count > names.length) {
+        return `${shown} 等 ${count} 人${action}`;
+    }
+    return `${shown} ${action}`;
+}
+
+// 创建单条消息的 DOM 元素
+function createMessageElement(data) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'chat-message';
+    if (data.message_uid) {
+        renderedMessageUids.add(data.message_uid);
+    }
+    messageDiv.innerHTML = `
+        <div class="d-flex justify-content-between align-items-center mb-1">
+            <strong><i class="fa fa-user-circle"></i> ${data.user}</strong>
+            <small class="text-muted"><i class="fa fa-clock-o"></i> ${data.timestamp}</small>
+        </div>
+        <p class="mb-0">${data.message}</p>
+    `;
+    return messageDiv;
+}
+
+// 添加一组消息到显示区域，只做一次 DOM 插入和滚动
+function addMessages(messages) {
     if (!messagesDiv) {
         console.error('消息容器不存在');
         return;
     }
     
     try {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = 'chat-message';
-        messageDiv.innerHTML = `
-            <div class="d-flex justify-content-between align-items-center mb-1">
-                <strong><i class="fa fa-user-circle"></i> ${data.user}</strong>
-                <small class="text-muted"><i class="fa fa-clock-o"></i> ${data.timestamp}</small>
-            </div>
-            <p class="mb-0">${data.message}</p>
-        `;
-        messagesDiv.appendChild(messageDiv);
+        const fragment = document.createDocumentFragment();
+        messages
+            .filter(data => !renderedMessageUids.has(data.message_uid))
+            .forEach(data => fragment.appendChild(createMessageElement(data)));
+        messagesDiv.appendChild(fragment);
         messagesDiv.scrollTop = messagesDiv.scrollHeight;
-        console.log('消息已添加到显示区域');
     } catch (error) {
         console.error('添加消息到显示区域时出错:', error);
     }
 }
 
+// 添加消息到显示区域
+function addMessage(data) {
+    addMessages([data]);
+}
+
 // 页面加载完成后初始化
 document.addEventListener('DOMContentLoaded', () => {
     console.log('开始初始化聊天功能');
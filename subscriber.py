@@ -0,0 +1,354 @@
+from collections import Counter, defaultdict
+import queue
+import redis
+import threading
+import time
+import zlib
+
+from log_config import get_logger
+import wire
+from metrics import REDIS_SUBSCRIBE_LAG_SECONDS
+
+logger = get_logger('subscriber')
+
+
+class RedisSubscriber:
+    """Redis 订阅流水线：接收线程 -> 有界队列 -> 工作线程池批量处理
+
+    同一聊天室的消息总是进入同一个工作线程的队列，保证房间内顺序；
+    每个工作线程一次最多取 batch_size 条消息交给 handle_batch 处理。
+    channels 为常驻订阅的频道，其余频道通过 retain/release 按引用计数动态订阅。
+    """
+
+    def __init__(self, redis_client, channels, handle_batch,
+                 workers=4, queue_size=1000, batch_size=100):
+        self.redis = redis_client
+        self.channels = channels
+        self.handle_batch = handle_batch
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self.threads = []
+
+        # 动态频道的引用计数，订阅变更交给接收线程执行
+        self._channel_refs = Counter()
+        self._channel_lock = threading.Lock()
+        self._pending_changes = queue.Queue()
+
+        # 各阶段统计：次数、累计耗时（秒）、最大耗时（秒）
+        self._stats_lock = threading.Lock()
+        self._stage_stats = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+        self._counters = defaultdict(int)
+
+    def start(self):
+        """启动接收线程和工作线程"""
+        if not self.redis:
+            logger.warning("Redis 未连接，跳过订阅")
+            return
+        for index in range(self.workers):
+            self._start_thread(self._worker_loop, index)
+        self._start_thread(self._receive_loop)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def retain(self, channel):
+        """增加频道引用，第一次引用时订阅"""
+        with self._channel_lock:
+            self._channel_refs[channel] += 1
+            if self._channel_refs[channel] == 1:
+                self._pending_changes.put(('subscribe', channel))
+
+    def release(self, channel):
+        """减少频道引用，没有引用时取消订阅"""
+        with self._channel_lock:
+            if self._channel_refs[channel] <= 0:
+                return
+            self._channel_refs[channel] -= 1
+            if self._channel_refs[channel] == 0:
+                del self._channel_refs[channel]
+                self._pending_changes.put(('unsubscribe', channel))
+
+    def subscribed_channels(self):
+        """当前动态订阅的频道及引用数"""
+        with self._channel_lock:
+            return dict(self._channel_refs)
+
+    def _apply_pending_changes(self, pubsub):
+        while True:
+            try:
+                action, channel = self._pending_changes.get_nowait()
+            except queue.Empty:
+                return
+            if action == 'subscribe':
+                pubsub.subscribe(channel)
+            else:
+                pubsub.unsubscribe(channel)
+
+    @staticmethod
+    def shard_key(data):
+        """计算消息的分片键，聊天消息按房间分片"""
+        payload = data.get('data') or {}
+        if data.get('type') == 'chat':
+            return f"room:{payload.get('room_id')}"
+        return data.get('type', '')
+
+    def record(self, stage, elapsed):
+        """记录某个阶段的一次耗时（秒）"""
+        with self._stats_lock:
+            stat = self._stage_stats[stage]
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+
+    def _subscribe(self):
+        """创建 PubSub 连接并订阅常驻频道和当前引用中的动态频道"""
+        pubsub = self.redis.pubsub()
+        channels = list(self.channels) + list(self.subscribed_channels())
+        if channels:
+            pubsub.subscribe(*channels)
+        return pubsub
+
+    def _receive_loop(self):
+        pubsub = None
+        backoff = 0.0
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe()
+                    if backoff:
+                        logger.info("Redis 订阅已恢复")
+                    backoff = 0.0
+                # 订阅变更只在接收线程内执行，PubSub 连接不跨线程使用
+                self._apply_pending_changes(pubsub)
+                message = pubsub.get_message(timeout=0.1)
+            except Exception as e:
+                # Redis 不可用（包括启动时）：按指数退避重连，重连后重新订阅所有频道
+                backoff = min(30.0, max(0.5, backoff * 2))
+                logger.warning("Redis 订阅连接出错，%.1f 秒后重连: %s", backoff, e)
+                with self._stats_lock:
+                    self._counters['reconnects'] += 1
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+                    pubsub = None
+                time.sleep(backoff)
+                continue
+
+            if not message or message['type'] != 'message':
+                continue
+            try:
+                # 队列满时阻塞接收线程，由 Redis 连接缓冲承担背压
+                self._dispatch(message['data'])
+            except Exception as e:
+                logger.warning("接收Redis消息时发生错误: %s", e)
+                with self._stats_lock:
+                    self._counters['receive_errors'] += 1
+
+    def _dispatch(self, raw, entry_id=None):
+        """解码一条消息并按分片键放入工作队列"""
+        started = time.perf_counter()
+        # JSON 和二进制格式按内容识别
+        data = wire.decode(raw)
+        # 发布端带上的 epoch 时间戳，旧版本实例的消息没有该字段
+        if data.get('published_at'):
+            REDIS_SUBSCRIBE_LAG_SECONDS.observe(time.time() - data['published_at'], type=data.get('type', ''))
+        key = self.shard_key(data)
+        index = zlib.crc32(key.encode('utf-8')) % self.workers
+        self.record('receive', time.perf_counter() - started)
+        self.queues[index].put((time.perf_counter(), data, entry_id))
+        with self._stats_lock:
+            self._counters['received'] += 1
+
+    def _acknowledge(self, entry_ids):
+        """handle_batch 正常返回后确认消息（抛出异常的批次不确认），Pub/Sub 没有确认机制"""
+
+    def _worker_loop(self, index):
+        worker_queue = self.queues[index]
+        while True:
+            batch = [worker_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(worker_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            now = time.perf_counter()
+            for enqueued_at, _, _ in batch:
+                self.record('queue_wait', now - enqueued_at)
+
+            try:
+                self.handle_batch([data for _, data, _ in batch])
+                self._acknowledge([entry_id for _, _, entry_id in batch])
+                with self._stats_lock:
+                    self._counters['processed'] += len(batch)
+                    self._counters['batches'] += 1
+            except Exception as e:
+                logger.exception("处理Redis消息批次时发生错误: %s", e)
+                with self._stats_lock:
+                    self._counters['batch_errors'] += 1
+            finally:
+                self.record('handle', time.perf_counter() - now)
+
+    def stats(self):
+        """返回队列深度和各阶段耗时（毫秒）"""
+        with self._stats_lock:
+            stages = {
+                stage: {
+                    'count': stat['count'],
+                    'avg_ms': round(stat['total'] / stat['count'] * 1000, 3) if stat['count'] else 0.0,
+                    'max_ms': round(stat['max'] * 1000, 3)
+                }
+                for stage, stat in self._stage_stats.items()
+            }
+            counters = dict(self._counters)
+        return {
+            'workers': self.workers,
+            'batch_size': self.batch_size,
+            'queue_depth': [q.qsize() for q in self.queues],
+            'channels': self.subscribed_channels(),
+            'stages': stages,
+            'counters': counters
+        }
+
+
+class StreamSubscriber(RedisSubscriber):
+    """基于 Redis Streams 的订阅流水线，消息在 Redis 中持久保存
+
+    每个实例使用以 consumer 命名的消费者组，组内的读取位置由 Redis 保存；
+    实例重启后从上次确认的位置继续读取，每次最多读 batch_size 条，
+    重放代价只与停机期间的消息数有关。批次处理成功后才 XACK，
+    处理失败的消息留在待确认列表中：启动时重放，运行期间每隔 reclaim_idle_ms 毫秒
+    用 XAUTOCLAIM 重新投递空闲超过该时间的消息（写入按 message_uid 幂等）。
+    """
+
+    def __init__(self, redis_client, stream, consumer, handle_batch,
+                 workers=4, queue_size=1000, batch_size=100, block_ms=1000, reclaim_idle_ms=30000):
+        super().__init__(redis_client, [], handle_batch,
+                         workers=workers, queue_size=queue_size, batch_size=batch_size)
+        self.stream = stream
+        self.group = consumer
+        self.consumer = consumer
+        self.block_ms = block_ms
+        self.reclaim_idle_ms = reclaim_idle_ms
+
+    def retain(self, channel):
+        """Streams 中包含所有聊天室的消息，不需要按频道订阅"""
+
+    def release(self, channel):
+        pass
+
+    def _ensure_group(self):
+        """创建本实例的消费者组；新实例从当前位置开始读取"""
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id='$', mkstream=True)
+            logger.info("已创建消费者组 %s", self.group)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+            self._check_gap()
+
+    def _check_gap(self):
+        """停机时间超过 Streams 的保留范围时，部分消息已被裁剪，只能整库复制补齐"""
+        try:
+            groups = {g['name'].decode('utf-8') if isinstance(g['name'], bytes) else g['name']: g
+                      for g in self.redis.xinfo_groups(self.stream)}
+            first = self.redis.xrange(self.stream, count=1)
+            last_delivered = groups[self.group]['last-delivered-id']
+            if first and _stream_id(first[0][0]) > _stream_id(last_delivered):
+                logger.error("消费者组 %s 的位置 %s 早于 Streams 中最早的消息 %s，停机期间的部分消息已被裁剪",
+                             self.group, last_delivered, first[0][0])
+                with self._stats_lock:
+                    self._counters['gap_detected'] += 1
+        except Exception as e:
+            logger.warning("检查 Streams 位置失败: %s", e)
+
+    def _reclaim(self):
+        """重新投递空闲超过 reclaim_idle_ms 的待确认消息，返回条数"""
+        start = '0-0'
+        reclaimed = 0
+        while True:
+            response = self.redis.xautoclaim(self.stream, self.group, self.consumer, self.reclaim_idle_ms,
+                                             start_id=start, count=self.batch_size)
+            start, entries = response[0], response[1]
+            self._dispatch_entries(entries)
+            reclaimed += len(entries)
+            if not entries or _stream_id(start) == (0, 0):
+                break
+        if reclaimed:
+            logger.info("重新投递 %d 条未确认的消息", reclaimed)
+            with self._stats_lock:
+                self._counters['reclaimed'] += reclaimed
+        return reclaimed
+
+    def _dispatch_entries(self, entries):
+        for entry_id, fields in entries:
+            try:
+                if not fields:
+                    # 待确认的消息已被裁剪
+                    self._acknowledge([entry_id])
+                    continue
+                self._dispatch(fields[b'm'], entry_id)
+            except Exception as e:
+                logger.warning("接收Redis消息时发生错误: %s", e)
+                with self._stats_lock:
+                    self._counters['receive_errors'] += 1
+
+    def _receive_loop(self):
+        # 先重放上次已投递但未确认的消息，读完后再读取新消息
+        cursor = '0'
+        group_ready = False
+        last_reclaim = time.monotonic()
+        while True:
+            try:
+                if not group_ready:
+                    self._ensure_group()
+                    group_ready = True
+                if cursor == '>' and time.monotonic() - last_reclaim >= self.reclaim_idle_ms / 1000.0:
+                    last_reclaim = time.monotonic()
+                    self._reclaim()
+                response = self.redis.xreadgroup(
+                    self.group, self.consumer, {self.stream: cursor},
+                    count=self.batch_size,
+                    block=None if cursor != '>' else self.block_ms
+                )
+            except Exception as e:
+                logger.warning("读取 Redis Streams 时发生错误: %s", e)
+                with self._stats_lock:
+                    self._counters['receive_errors'] += 1
+                time.sleep(1)
+                continue
+
+            entries = response[0][1] if response else []
+            if cursor != '>':
+                if not entries:
+                    cursor = '>'
+                    continue
+                cursor = entries[-1][0]
+                with self._stats_lock:
+                    self._counters['replayed'] += len(entries)
+
+            self._dispatch_entries(entries)
+
+    def _acknowledge(self, entry_ids):
+        entry_ids = [entry_id for entry_id in entry_ids if entry_id is not None]
+        if entry_ids:
+            self.redis.xack(self.stream, self.group, *entry_ids)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(stream=self.stream, group=self.group)
+        return stats
+
+
+def _stream_id(entry_id):
+    """'毫秒-序号' 转为可比较的元组"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    milliseconds, _, sequence = entry_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
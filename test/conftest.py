@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# 测试直接导入项目根目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUERY_BUDGET = 20
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    """使用临时 SQLite 数据库导入 app（app 在导入时读取配置，需要先设置环境变量）"""
+    pytest.importorskip('flask_socketio')
+    pytest.importorskip('cryptography')
+    db_dir = tempfile.mkdtemp()
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(db_dir, 'test.db')}",
+        'QUERY_BUDGET': str(QUERY_BUDGET),
+        'ASYNC_MODE': 'threading',
+        'CHAT_DURABILITY': 'sync',
+        'FEED_CACHE_TTL': '0',
+        'FEED_TOTAL_TTL': '0',
+        'KEY_POOL_PROCESSES': '0',
+    })
+    import app
+    app.app.config['TESTING'] = True
+    app.init_database()
+    return app
@@ -0,0 +1,51 @@
+import threading
+import time
+
+from coalescer import EmitCoalescer
+
+
+def start_task(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def make_coalescer(window_ms=50):
+    emitted = []
+    done = threading.Event()
+
+    def emit_batch(room_id, messages):
+        emitted.append((room_id, messages))
+        done.set()
+
+    return EmitCoalescer(emit_batch, window_ms, start_task, time.sleep), emitted, done
+
+
+def test_messages_in_window_are_emitted_once_in_order():
+    coalescer, emitted, done = make_coalescer()
+    for index in range(5):
+        coalescer.add('1', {'message': index})
+    assert done.wait(2)
+    assert emitted == [('1', [{'message': index} for index in range(5)])]
+
+
+def test_rooms_are_coalesced_separately():
+    coalescer, emitted, _ = make_coalescer()
+    coalescer.add('1', 'a')
+    coalescer.add('2', 'b')
+    coalescer.add('1', 'c')
+    deadline = time.monotonic() + 2
+    while len(emitted) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(emitted) == [('1', ['a', 'c']), ('2', ['b'])]
+
+
+def test_new_window_starts_after_flush():
+    coalescer, emitted, done = make_coalescer(window_ms=10)
+    coalescer.add('1', 'a')
+    assert done.wait(2)
+    done.clear()
+    coalescer.add('1', 'b')
+    assert done.wait(2)
+    assert emitted == [('1', ['a']), ('1', ['b'])]
@@ -0,0 +1,20 @@
+"""没有 ON CONFLICT 的数据库逐行插入：冲突的行跳过，同一事务中其他行照常写入"""
+
+
+def test_insert_each_skips_conflicting_rows(app_module):
+    import database
+
+    table = database.User.__table__
+    with app_module.app.app_context():
+        try:
+            database.db.session.execute(table.insert(), {'username': 'dup', 'email': 'dup@example.com'})
+            inserted = database.insert_each_ignore_duplicates(table, [
+                {'username': 'dup', 'email': 'other@example.com'},
+                {'username': 'fresh', 'email': 'fresh@example.com'},
+            ])
+            assert inserted == 1
+            usernames = database.db.session.query(database.User.username)\
+                .filter(database.User.username.in_(['dup', 'fresh'])).all()
+            assert sorted(row.username for row in usernames) == ['dup', 'fresh']
+        finally:
+            database.db.session.rollback()
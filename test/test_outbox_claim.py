@@ -0,0 +1,43 @@
+"""发件箱认领：多个发布者同时认领时每条消息只被一个拿到，放弃认领或租约到期后可以重新认领"""
+import pytest
+
+
+@pytest.fixture
+def outbox(app_module):
+    import database
+
+    with app_module.app.app_context():
+        database.OutboxMessage.query.delete()
+        database.add_outbox_entries([
+            {'channel': 'test', 'message_type': 'post', 'payload': b'%d' % index} for index in range(3)
+        ])
+        database.db.session.commit()
+        yield database
+        database.db.session.rollback()
+        database.OutboxMessage.query.delete()
+        database.db.session.commit()
+
+
+def ids(rows):
+    return [row.id for row in rows]
+
+
+def test_concurrent_claims_are_disjoint(outbox):
+    first = outbox.claim_outbox_batch(2, 30)
+    second = outbox.claim_outbox_batch(2, 30)
+    assert [row.payload for row in first] == [b'0', b'1']
+    assert [row.payload for row in second] == [b'2']
+    assert outbox.claim_outbox_batch(2, 30) == []
+
+
+def test_released_entries_are_claimed_again(outbox):
+    first = outbox.claim_outbox_batch(3, 30)
+    outbox.release_outbox_entries(ids(first[:1]))
+    outbox.db.session.commit()
+    assert ids(outbox.claim_outbox_batch(3, 30)) == ids(first[:1])
+
+
+def test_expired_lease_is_claimed_again(outbox):
+    # 发布者认领后崩溃，租约到期
+    first = outbox.claim_outbox_batch(3, -1)
+    assert ids(outbox.claim_outbox_batch(3, 30)) == ids(first)
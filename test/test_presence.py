@@ -0,0 +1,60 @@
+"""在线人数：其他实例的在线用户走缓存，Redis 不可用时为未知（None）且不会每次请求都重试"""
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from presence import PresenceTracker
+
+
+class FlakyRedis:
+    """转发到 FakeRedis，down 为 True 时每次调用都失败，并记录调用次数"""
+
+    def __init__(self, server):
+        self.client = fakeredis.FakeRedis(server=server)
+        self.down = False
+        self.calls = 0
+
+    def __getattr__(self, name):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError('redis down')
+        return getattr(self.client, name)
+
+
+@pytest.fixture
+def trackers():
+    server = fakeredis.FakeServer()
+    remote = PresenceTracker(fakeredis.FakeRedis(server=server), 'remote')
+    local = PresenceTracker(FlakyRedis(server), 'local')
+    remote.join('sid-1', '1', 'alice')
+    remote.join('sid-2', '1', 'bob')
+    remote.heartbeat()
+    local.join('sid-3', '1', 'alice')
+    return local, remote
+
+
+def test_counts_union_local_and_remote(trackers):
+    local, _ = trackers
+    assert local.online_counts(['1', '2']) == {'1': 2, '2': 0}
+
+
+def test_cached_counts_skip_redis(trackers):
+    local, _ = trackers
+    local.online_counts(['1'])
+    calls = local.redis.calls
+    local.join('sid-4', '1', 'carol')  # 本实例的变化立即可见
+    assert local.online_counts(['1']) == {'1': 3}
+    assert local.redis.calls == calls
+
+
+def test_redis_failure_reports_unknown_and_backs_off(trackers):
+    local, _ = trackers
+    local.redis.down = True
+    assert local.online_counts(['1']) == {'1': None}
+    calls = local.redis.calls
+    assert local.online_counts(['1']) == {'1': None}
+    assert local.redis.calls == calls
+    # Redis 恢复后下一次心跳成功即重新查询
+    local.redis.down = False
+    local.heartbeat()
+    assert local.online_counts(['1']) == {'1': 2}
@@ -0,0 +1,86 @@
+"""QUERY_BUDGET 测试模式：页面的 SQL 查询数不超过预算，且不随帖子和消息数量增长（没有 N+1 查询）"""
+import pytest
+
+
+@pytest.fixture(scope='module')
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture(scope='module')
+def room_id(app_module, client):
+    response = client.post('/chat/create', data={'name': '查询预算', 'description': ''})
+    assert response.status_code == 302
+    room_id = int(response.headers['Location'].rstrip('/').rsplit('/', 1)[-1])
+    seed(app_module, client, room_id, 3)
+    return room_id
+
+
+def seed(app_module, client, room_id, count):
+    """发布 count 条帖子和聊天消息"""
+    start = seed.total
+    seed.total += count
+    for index in range(start, seed.total):
+        client.post('/post', data={'title': f'帖子 {index}', 'content': f'内容 {index}'})
+    socket = app_module.socketio.test_client(app_module.app, flask_test_client=client)
+    socket.emit('join', {'room_id': str(room_id)})
+    for index in range(start, seed.total):
+        socket.emit('message', {'room_id': str(room_id), 'content': f'消息 {index}'})
+    errors = [event for event in socket.get_received() if event['name'] == 'error']
+    socket.disconnect()
+    assert errors == []
+
+seed.total = 0
+
+
+def page_urls(room_id):
+    return ['/', f'/chat/{room_id}', f'/chat/{room_id}/history']
+
+
+def query_count(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, url
+    return int(response.headers['X-Query-Count'])
+
+
+@pytest.mark.parametrize('page', range(3))
+def test_page_within_query_budget(app_module, client, room_id, page):
+    url = page_urls(room_id)[page]
+    client.get(url)  # 预热进程内的用户、成员和密钥缓存
+    assert query_count(client, url) <= app_module.app.config['QUERY_BUDGET']
+
+
+def test_query_count_does_not_grow_with_rows(app_module, client, room_id):
+    urls = page_urls(room_id)
+    for url in urls:
+        client.get(url)
+    before = {url: query_count(client, url) for url in urls}
+    seed(app_module, client, room_id, 10)
+    for url in urls:
+        client.get(url)
+    assert {url: query_count(client, url) for url in urls} == before
+
+
+def test_over_budget_page_fails():
+    pytest.importorskip('flask')
+    from flask import Flask
+    from sqlalchemy import create_engine, text
+    from utils import QueryBudgetExceeded, install_query_counter
+
+    engine = create_engine('sqlite://')
+    engine.connect().close()
+    budget_app = Flask(__name__)
+    budget_app.config['TESTING'] = True
+    install_query_counter(budget_app, 1)
+
+    @budget_app.route('/queries/<int:count>')
+    def run_queries(count):
+        with engine.connect() as connection:
+            for _ in range(count):
+                connection.execute(text('SELECT 1'))
+        return 'ok'
+
+    budget_client = budget_app.test_client()
+    assert budget_client.get('/queries/1').headers['X-Query-Count'] == '1'
+    with pytest.raises(QueryBudgetExceeded):
+        budget_client.get('/queries/2')
@@ -0,0 +1,60 @@
+"""远程作者按 (username, 作者的 users.host_id) 映射，来源实例重启（HOST_ID 变化）后仍精确匹配"""
+import pytest
+
+
+def remote_post(post_uid, username, author_host, sender_host):
+    return {
+        'id': 1,
+        'post_uid': post_uid,
+        'title': '远程动态',
+        'content': '内容',
+        'date_posted': '2024-03-01 12:00:00',
+        'user_id': 99,
+        'host_id': sender_host,
+        'author_host': author_host,
+        'username': username,
+    }
+
+
+def post_authors(app_module, *post_uids):
+    with app_module.app.app_context():
+        rows = app_module.db.session.query(app_module.Post.post_uid, app_module.User.username,
+                                           app_module.User.host_id)\
+            .join(app_module.User, app_module.Post.user_id == app_module.User.id)\
+            .filter(app_module.Post.post_uid.in_(post_uids)).all()
+    return {row.post_uid: (row.username, row.host_id) for row in rows}
+
+
+@pytest.fixture
+def collisions(app_module):
+    counter = app_module.metrics.REMOTE_IDENTITY_COLLISIONS
+    start = counter.value()
+    return lambda: counter.value() - start
+
+
+def test_author_matches_after_origin_restart(app_module, collisions):
+    # 来源实例第一次启动
+    app_module.ingest_remote_batch([], [remote_post('restart-1', 'remote_author', 'author-host', 'boot-1')], [])
+    # 来源实例重启后 HOST_ID 变化，本实例也丢弃了映射缓存
+    app_module.remote_identities.invalidate()
+    app_module.ingest_remote_batch([], [remote_post('restart-2', 'remote_author', 'author-host', 'boot-2')], [])
+
+    authors = post_authors(app_module, 'restart-1', 'restart-2')
+    assert authors == {
+        'restart-1': ('remote_author', 'author-host'),
+        'restart-2': ('remote_author', 'author-host'),
+    }
+    assert collisions() == 0
+
+
+def test_same_username_on_another_instance_is_counted(app_module, collisions):
+    local_username = app_module.USERNAME
+    app_module.ingest_remote_batch([], [remote_post('collision-1', local_username, 'other-host', 'boot-3')], [])
+    assert collisions() == 1
+
+
+def test_old_senders_without_author_host_fall_back_to_host_id(app_module):
+    post = remote_post('legacy-1', 'legacy_author', None, 'legacy-boot')
+    del post['author_host']
+    app_module.ingest_remote_batch([], [post], [])
+    assert post_authors(app_module, 'legacy-1') == {'legacy-1': ('legacy_author', 'legacy-boot')}
@@ -0,0 +1,53 @@
+"""Streams 模式下处理失败的批次不确认，运行期间由 XAUTOCLAIM 重新投递"""
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('cryptography')
+
+import wire
+from subscriber import StreamSubscriber
+
+STREAM = 'test:stream'
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_failed_batch_is_redelivered_without_restart():
+    redis_client = fakeredis.FakeRedis()
+    batches = []
+    handled = threading.Event()
+
+    def handle_batch(batch):
+        batches.append([data['data']['post_uid'] for data in batch])
+        if len(batches) == 1:
+            raise RuntimeError('database is locked')
+        handled.set()
+
+    subscriber = StreamSubscriber(redis_client, STREAM, 'consumer-1', handle_batch,
+                                  workers=1, block_ms=10, reclaim_idle_ms=100)
+    subscriber.start()
+    # 消费者组从创建时的位置开始读取
+    assert wait_for(lambda: redis_client.exists(STREAM) and redis_client.xinfo_groups(STREAM))
+
+    redis_client.xadd(STREAM, {'m': wire.encode({
+        'type': 'post',
+        'published_at': time.time(),
+        'data': {'post_uid': 'redelivered-1', 'host_id': 'other'}
+    })})
+
+    assert handled.wait(5)
+    assert batches == [['redelivered-1'], ['redelivered-1']]
+    assert wait_for(lambda: redis_client.xpending(STREAM, 'consumer-1')['pending'] == 0)
+    counters = subscriber.stats()['counters']
+    assert counters['batch_errors'] == 1
+    assert counters['reclaimed'] == 1
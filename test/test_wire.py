@@ -0,0 +1,79 @@
+from datetime import datetime
+import base64
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+import wire
+
+
+def chat_message():
+    return {
+        'type': 'chat',
+        'published_at': 1700000000.123456,
+        'data': {
+            'id': 7,
+            'message_uid': 'host-000000000007',
+            'content': 'v2:3:' + base64.b64encode(os.urandom(40)).decode('utf-8'),
+            'user_id': 1,
+            'room_id': 2,
+            'host_id': 'host',
+            'username': 'user_port_5001',
+            'author_host': 'author-host',
+            'timestamp': datetime(2024, 3, 1, 12, 30, 45)
+        }
+    }
+
+
+def test_json_round_trip():
+    message = chat_message()
+    raw = wire.encode(message)
+    assert not wire.is_binary(raw)
+    assert wire.decode(raw) == message
+
+
+def test_json_post_round_trip():
+    message = {'type': 'post', 'published_at': 1.5, 'data': {'id': 1, 'title': 't', 'post_uid': 'p'}}
+    assert wire.decode(wire.encode(message)) == message
+
+
+def test_binary_round_trip():
+    pytest.importorskip('msgpack')
+    message = chat_message()
+    raw = wire.encode(message, binary=True)
+    assert wire.is_binary(raw)
+    assert len(raw) < len(wire.encode(message))
+    decoded = wire.decode(raw)
+    assert decoded['data'] == message['data']
+    assert decoded['published_at'] == pytest.approx(message['published_at'], abs=1e-6)
+
+
+def test_binary_legacy_rsa_ciphertext():
+    pytest.importorskip('msgpack')
+    message = chat_message()
+    message['data']['content'] = base64.b64encode(os.urandom(256)).decode('utf-8')
+    assert wire.decode(wire.encode(message, binary=True))['data']['content'] == message['data']['content']
+
+
+def test_binary_version_1_without_author_host():
+    msgpack = pytest.importorskip('msgpack')
+    message = chat_message()
+    data = message['data']
+    key_version, ciphertext = 3, base64.b64decode(data['content'].split(':', 2)[2])
+    body = msgpack.packb({
+        't': 'chat',
+        'p': int(message['published_at'] * 1000000),
+        'd': [data[field] for field in ('id', 'message_uid', 'user_id', 'room_id', 'host_id', 'username')]
+             + [key_version, ciphertext, 1709296245]
+    }, use_bin_type=True)
+    decoded = wire.decode(wire.WIRE_MAGIC + bytes([1]) + body)
+    assert 'author_host' not in decoded['data']
+    assert decoded['data']['content'] == data['content']
+    assert decoded['data']['timestamp'] == data['timestamp']
+
+
+def test_unknown_binary_version_is_rejected():
+    with pytest.raises(wire.WireFormatError):
+        wire.decode(wire.WIRE_MAGIC + bytes([wire.WIRE_VERSION + 1]) + b'\x80')
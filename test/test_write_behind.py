@@ -0,0 +1,77 @@
+import threading
+
+from write_behind import WriteBehindWriter
+
+
+class BadRow(Exception):
+    pass
+
+
+def make_writer(flush_rows, **kwargs):
+    options = dict(max_batch=10, max_delay_ms=1, max_retries=2, max_backoff_ms=5,
+                   is_permanent=lambda error: isinstance(error, BadRow))
+    options.update(kwargs)
+    return WriteBehindWriter(flush_rows, **options)
+
+
+def test_rows_are_flushed_in_batches():
+    flushed = []
+    writer = make_writer(lambda rows: flushed.append(list(rows)), max_batch=3)
+    for row in range(7):
+        writer.submit(row)
+    writer.flush()
+    assert flushed == [[0, 1, 2], [3, 4, 5], [6]]
+    assert writer.stats()['flushed'] == 7
+
+
+def test_transient_failures_are_retried_until_written():
+    failures = {'left': 5}
+    flushed = []
+
+    def flush_rows(rows):
+        if failures['left']:
+            failures['left'] -= 1
+            raise RuntimeError('database is locked')
+        flushed.extend(rows)
+
+    writer = make_writer(flush_rows)
+    writer.submit('a')
+    writer.submit('b')
+    writer.flush()
+    assert sorted(flushed) == ['a', 'b']
+    assert failures['left'] == 0
+    assert writer.stats()['dropped'] == 0
+
+
+def test_bad_rows_are_isolated_and_dropped():
+    flushed = []
+
+    def flush_rows(rows):
+        if 'bad' in rows:
+            raise BadRow('constraint failed')
+        flushed.extend(rows)
+
+    writer = make_writer(flush_rows)
+    for row in ('a', 'bad', 'b'):
+        writer.submit(row)
+    writer.flush()
+    assert flushed == ['a', 'b']
+    assert writer.stats()['dropped'] == 1
+    assert writer.stats()['flushed'] == 2
+
+
+def test_background_thread_writes_and_stop_flushes_the_rest():
+    flushed = []
+    written = threading.Event()
+
+    def flush_rows(rows):
+        flushed.extend(rows)
+        written.set()
+
+    writer = make_writer(flush_rows)
+    writer.start()
+    writer.submit(1)
+    assert written.wait(2)
+    writer.submit(2)
+    writer.stop()
+    assert flushed == [1, 2]
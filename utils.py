@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+
+class QueryBudgetExceeded(AssertionError):
+    """页面的 SQL 查询次数超过预算"""
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def install_query_counter(app, budget):
+    """统计每个请求执行的 SQL 查询数，超过 budget 时让请求失败（用于测试模式）
+
+    查询数通过 X-Query-Count 响应头返回，便于定位 N+1 查询。
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+    @app.before_request
+    def reset_query_count():
+        g.query_count = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+        if count > budget:
+            raise QueryBudgetExceeded(f"{request.path} 执行了 {count} 条查询，超过预算 {budget}")
+        return response
+
+
+class TTLCache:
+    """带过期时间的简单内存缓存，线程安全"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key=None):
+        """删除指定键，不传键时清空缓存"""
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+
+def make_offloader(async_mode):
+    """返回 offload(fn, *args, **kwargs)：协程模式下在原生线程池中执行阻塞调用
+
+    threading 模式下直接调用；eventlet 使用 tpool，gevent 使用 hub 的线程池。
+    """
+    if async_mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute
+    if async_mode == 'gevent':
+        from gevent import get_hub
+
+        def offload(fn, *args, **kwargs):
+            return get_hub().threadpool.apply(fn, args, kwargs)
+        return offload
+
+    def offload(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+    return offload
+
+
+class StartupTimer:
+    """记录启动各阶段的耗时"""
+
+    def __init__(self, started=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.phases = {}
+
+    def record(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def report(self):
+        """返回 {阶段: 毫秒}，total 为从开始计时到现在的总耗时"""
+        report = {name: round(elapsed * 1000, 1) for name, elapsed in self.phases.items()}
+        report['total'] = round((time.perf_counter() - self.started) * 1000, 1)
+        return report
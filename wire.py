@@ -0,0 +1,118 @@
+"""实例间 Redis 消息的编码
+
+两种格式可以同时存在，订阅端按内容自动识别：
+  json    旧格式，时间戳为 '%Y-%m-%d %H:%M:%S' 字符串，密文为 Base64 字符串
+  binary  b'W3' + 版本号（1 字节）+ msgpack 数据；时间戳为整数 epoch，密文为原始字节
+
+发布端在 auto 模式下只有当所有订阅 forum_channel 的实例都能解码 binary 时才使用它：
+支持 binary 的实例会额外订阅 WIRE_CAPABILITY_CHANNEL，两个频道的订阅数相同即表示全部支持。
+binary 版本 2 的聊天消息增加了 author_host 字段，仍可解码版本 1 的消息。
+"""
+import base64
+import calendar
+from datetime import datetime
+import json
+
+from crypto_utils import MESSAGE_FORMAT_V2
+
+try:
+    import msgpack
+except ImportError:  # 未安装 msgpack 时只能使用 json
+    msgpack = None
+
+WIRE_MAGIC = b'W3'
+WIRE_VERSION = 2
+WIRE_CAPABILITY_CHANNEL = f'forum_channel:wire:v{WIRE_VERSION}'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 二进制格式中聊天消息字段的顺序（按版本）
+_CHAT_FIELDS = {
+    1: ('id', 'message_uid', 'user_id', 'room_id', 'host_id', 'username'),
+    2: ('id', 'message_uid', 'user_id', 'room_id', 'host_id', 'username', 'author_host'),
+}
+
+
+class WireFormatError(ValueError):
+    """无法解码的消息"""
+
+
+def binary_supported():
+    return msgpack is not None
+
+
+def is_binary(raw):
+    return isinstance(raw, bytes) and raw[:len(WIRE_MAGIC)] == WIRE_MAGIC
+
+
+def _split_ciphertext(content):
+    """'v2:<版本>:<Base64>' -> (版本, 原始字节)；旧的 RSA 消息版本为 None"""
+    if content.startswith(MESSAGE_FORMAT_V2 + ':'):
+        _, version, payload = content.split(':', 2)
+        return int(version), base64.b64decode(payload)
+    return None, base64.b64decode(content)
+
+
+def _join_ciphertext(version, raw):
+    payload = base64.b64encode(raw).decode('utf-8')
+    if version is None:
+        return payload
+    return f'{MESSAGE_FORMAT_V2}:{version}:{payload}'
+
+
+def _encode_json(message):
+    if message['type'] == 'chat':
+        data = dict(message['data'], timestamp=message['data']['timestamp'].strftime(TIMESTAMP_FORMAT))
+        message = dict(message, data=data)
+    return json.dumps(message).encode('utf-8')
+
+
+def _encode_binary(message):
+    data = message['data']
+    if message['type'] == 'chat':
+        key_version, ciphertext = _split_ciphertext(data['content'])
+        data = [data.get(field) for field in _CHAT_FIELDS[WIRE_VERSION]] + [
+            key_version,
+            ciphertext,
+            calendar.timegm(data['timestamp'].utctimetuple())
+        ]
+    body = msgpack.packb({
+        't': message['type'],
+        'p': int(message['published_at'] * 1000000),
+        'd': data
+    }, use_bin_type=True)
+    return WIRE_MAGIC + bytes([WIRE_VERSION]) + body
+
+
+def encode(message, binary=False):
+    """编码 {'type', 'published_at', 'data'}；聊天消息的 data['timestamp'] 为 datetime"""
+    if binary:
+        return _encode_binary(message)
+    return _encode_json(message)
+
+
+def _decode_binary(raw):
+    if raw[2] not in _CHAT_FIELDS:
+        raise WireFormatError(f"不支持的消息版本: {raw[2]}")
+    if msgpack is None:
+        raise WireFormatError("收到二进制消息，但未安装 msgpack")
+    body = msgpack.unpackb(raw[3:], raw=False)
+    data = body['d']
+    if body['t'] == 'chat':
+        chat_fields = _CHAT_FIELDS[raw[2]]
+        fields = dict(zip(chat_fields, data))
+        key_version, ciphertext, epoch = data[len(chat_fields):]
+        fields['content'] = _join_ciphertext(key_version, ciphertext)
+        fields['timestamp'] = datetime.utcfromtimestamp(epoch)
+        data = fields
+    return {'type': body['t'], 'published_at': body['p'] / 1000000, 'data': data}
+
+
+def decode(raw):
+    """解码任一格式的消息，聊天消息的 data['timestamp'] 统一转换为 datetime"""
+    if is_binary(raw):
+        return _decode_binary(raw)
+    message = json.loads(raw)
+    if message.get('type') == 'chat':
+        data = message['data']
+        data['timestamp'] = datetime.strptime(data['timestamp'], TIMESTAMP_FORMAT)
+    return message
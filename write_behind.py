@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+
+from log_config import get_logger
+
+logger = get_logger('write_behind')
+
+
+class WriteBehindWriter:
+    """聊天消息的后台批量写入（group commit）
+
+    消息行先进入有界缓冲区，后台线程每攒够 max_batch 条或等待 max_delay_ms 毫秒后
+    调用 flush_rows 一次性写入并提交。缓冲区满时 submit 会阻塞，形成背压。
+
+    写入失败时按指数退避（最长 max_backoff_ms 毫秒）重试；整批连续失败 max_retries 次后逐条写入，
+    is_permanent(异常) 为真的行（重试也无法写入，如违反约束）被丢弃并计数，
+    其余的行（数据库暂时不可用等）一直重试到写入成功，只有进程退出时才放弃。
+    """
+
+    def __init__(self, flush_rows, max_batch=100, max_delay_ms=50, buffer_size=10000, max_retries=3,
+                 max_backoff_ms=5000, is_permanent=None):
+        self.flush_rows = flush_rows
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_retries = max(1, max_retries)
+        self.max_backoff = max(self.max_delay, max_backoff_ms / 1000.0)
+        self.is_permanent = is_permanent or (lambda error: False)
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.thread = None
+        self._stopping = threading.Event()
+        self.flushed = 0
+        self.dropped = 0
+        self.retrying = 0
+        self.retries = 0
+
+    def start(self):
+        """启动后台写入线程"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, row):
+        """提交一条待写入的消息行"""
+        self.buffer.put(row)
+
+    def _take_batch(self):
+        """取出一批消息：第一条最多等待 max_delay，之后在截止时间前尽量攒满"""
+        try:
+            batch = [self.buffer.get(timeout=self.max_delay)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.buffer.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        delay = max(self.max_delay, 0.01)
+        attempt = 0
+        isolated = False
+        try:
+            while batch:
+                try:
+                    self.flush_rows(batch)
+                    self.flushed += len(batch)
+                    return
+                except Exception as e:
+                    attempt += 1
+                    self.retries += 1
+                    error = e
+                    logger.warning("批量写入 %d 条聊天消息失败（第 %d 次）: %s", len(batch), attempt, e)
+
+                if attempt >= self.max_retries:
+                    if not isolated or self.is_permanent(error):
+                        # 逐条写入，只留下暂时无法写入的行
+                        isolated = True
+                        batch = self._write_rows(batch)
+                        if not batch:
+                            return
+                    if self._stopping.is_set():
+                        self.dropped += len(batch)
+                        logger.error("进程退出，放弃写入 %d 条聊天消息", len(batch))
+                        return
+                self.retrying = len(batch)
+                time.sleep(delay)
+                delay = min(self.max_backoff, delay * 2)
+        finally:
+            self.retrying = 0
+
+    def _write_rows(self, batch):
+        """逐条写入，丢弃无法写入的行，返回需要继续重试的行"""
+        remaining = []
+        for row in batch:
+            try:
+                self.flush_rows([row])
+                self.flushed += 1
+            except Exception as e:
+                if self.is_permanent(e):
+                    self.dropped += 1
+                    logger.error("丢弃无法写入的聊天消息: %s", e)
+                else:
+                    remaining.append(row)
+        return remaining
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """在当前线程中写入缓冲区里剩余的全部消息"""
+        while True:
+            batch = []
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self, timeout=5):
+        """停止后台线程并写入剩余消息（进程退出时调用）"""
+        self._stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        return {
+            'buffered': self.buffer.qsize(),
+            'retrying': self.retrying,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'retries': self.retries
+        }